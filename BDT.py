@@ -0,0 +1,212 @@
+# Modo por lotes: lee perfiles de sitio de un TOML/YAML y descarga varias búsquedas sin preguntar nada
+# Uso: python BDT.py -p danbooru "cat_ears rating:g" https://danbooru.donmai.us/posts?tags=dog&page={{page}}
+#      python BDT.py -l busquedas.toml   (lista de [[busquedas]] con perfil, busqueda y peso)
+# Modo distribuido: un coordinador recorre las búsquedas y llena una cola SQLite compartida,
+# y los trabajadores (en esta u otras máquinas) la van vaciando:
+#      python BDT.py -p danbooru "cat_ears" --cola /compartido/cola.sqlite3
+#      python BDT.py --trabajador --cola /compartido/cola.sqlite3 -o descarga
+import argparse
+import importlib.util
+import os
+import sys
+from urllib.parse import quote_plus
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ENGINE_FILE = os.path.join(ROOT, 'booru-downloader 9.py')
+DEFAULT_PROFILES = 'perfiles.toml'
+
+def load_engine():
+    # El script principal tiene espacios en el nombre, así que no se puede importar con import
+    if 'booru_downloader' in sys.modules:
+        return sys.modules['booru_downloader']
+    spec = importlib.util.spec_from_file_location('booru_downloader', ENGINE_FILE)
+    engine = importlib.util.module_from_spec(spec)
+    sys.modules['booru_downloader'] = engine
+    spec.loader.exec_module(engine)
+    return engine
+
+def read_profiles(path):
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("Para perfiles en YAML hace falta PyYAML (pip install pyyaml)")
+        with open(path, encoding='utf-8') as f:
+            return yaml.safe_load(f) or {}
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            raise ValueError("Para perfiles en TOML hace falta Python 3.11 o tomli (pip install tomli)")
+    with open(path, 'rb') as f:
+        return tomllib.load(f)
+
+def read_search_list(path, default_profile):
+    # Cada entrada: busqueda (URL o etiquetas), y opcionalmente perfil y peso
+    searches = []
+    for item in read_profiles(path).get('busquedas', []):
+        if not item.get('busqueda'):
+            raise ValueError(f"Hay una entrada sin 'busqueda' en {path}")
+        searches.append((item.get('perfil', default_profile), item['busqueda'], int(item.get('peso', 1))))
+    return searches
+
+def get_profile(profiles, name):
+    if name is None:
+        if len(profiles) != 1:
+            raise ValueError(f"Hay varios perfiles, elige uno con --perfil: {', '.join(profiles)}")
+        name = next(iter(profiles))
+    if name not in profiles:
+        raise ValueError(f"No existe el perfil {name} (hay: {', '.join(profiles)})")
+    profile = dict(profiles[name])
+    # Cada resolver necesita lo suyo: sin API hacen falta los selectores, con API basta la búsqueda
+    resolver = load_engine().get_resolver(profile)
+    missing = [key for key in resolver.required_keys if not profile.get(key)]
+    if missing:
+        raise ValueError(f"Al perfil {name} le falta: {', '.join(missing)}")
+    if uses_pages(profile) and '{{page}}' not in profile['search_url']:
+        raise ValueError(f"El search_url del perfil {name} necesita el marcador {{{{page}}}}")
+    return profile
+
+def uses_pages(profile):
+    # Con una API el número de página lo pone el resolver; search_url solo aporta las etiquetas
+    return profile.get('resolver', 'html') == 'html'
+
+def search_url_for(search, profile):
+    # Una URL se usa tal cual; cualquier otra cosa son etiquetas para el {tags} del perfil
+    if search.startswith(('http://', 'https://')):
+        if uses_pages(profile) and '{{page}}' not in search:
+            raise ValueError(f"La búsqueda {search} necesita el marcador {{{{page}}}}")
+        return search
+    if '{tags}' not in profile['search_url']:
+        raise ValueError("Para buscar por etiquetas el search_url del perfil necesita {tags}")
+    return profile['search_url'].replace('{tags}', quote_plus(search))
+
+def check_run_settings(engine, configs):
+    # Lo que vale para toda la ejecución sale de la primera búsqueda: si los perfiles no coinciden,
+    # mejor avisar que usar en silencio los valores de uno solo
+    for key in engine.RUN_KEYS:
+        values = {repr(config.get(key)) for config in configs}
+        if len(values) > 1:
+            raise ValueError(f"Los perfiles de estas búsquedas tienen distinto {key} ({', '.join(sorted(values))}) y es un ajuste de toda la ejecución: pon el mismo en todos")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Descarga búsquedas de boorus a partir de un perfil de sitio, sin preguntas.")
+    parser.add_argument('busquedas', nargs='*', help="URLs de búsqueda con {{page}} o etiquetas para el {tags} del perfil")
+    parser.add_argument('-l', '--lista', help="archivo TOML o YAML con una lista de [[busquedas]] (perfil, busqueda, peso)")
+    parser.add_argument('-f', '--perfiles', default=DEFAULT_PROFILES, help=f"archivo TOML o YAML con los perfiles (por defecto {DEFAULT_PROFILES})")
+    parser.add_argument('-p', '--perfil', help="perfil a usar; se puede omitir si el archivo solo tiene uno")
+    parser.add_argument('-o', '--carpeta', default='descarga', help="carpeta de descarga (por defecto descarga)")
+    parser.add_argument('--motor', choices=('threads', 'async'), help="motor de descarga; por defecto el del perfil o threads")
+    parser.add_argument('--parser', help="parser HTML; por defecto el del perfil o el más rápido instalado")
+    parser.add_argument('--procesos', type=int, help="procesos para analizar el HTML en paralelo (0 = en los hilos de descarga)")
+    parser.add_argument('--completo', action='store_true', help="recorrer las búsquedas enteras aunque ya se hayan descargado antes")
+    parser.add_argument('--cola', help="cola SQLite compartida: con búsquedas hace de coordinador, con --trabajador la vacía")
+    parser.add_argument('--trabajador', action='store_true', help="alquilar posts de --cola, descargarlos y avisar (no necesita perfiles)")
+    parser.add_argument('--hilos', type=int, help="hilos de descarga del trabajador")
+    parser.add_argument('--alquiler', type=float, help="segundos que un trabajador se queda un post antes de que caduque")
+    parser.add_argument('--no-esperar', action='store_true', help="el coordinador sale al terminar de recorrer, sin esperar a los trabajadores")
+    parser.add_argument('--metricas', help="archivo de métricas por etapa, reescrito cada poco: .prom (Prometheus) o .json")
+    parser.add_argument('--perfilado', '--profile', action='store_true', help="al terminar, tiempo real y de CPU de cada etapa")
+    parser.add_argument('--traza', action='store_true', help="con --perfilado, línea de tiempo de etapas y peticiones por hilo (Chrome trace) en <carpeta>/.bdt/perfil/")
+    parser.add_argument('--muestras', action='store_true', help="con --perfilado, muestreo de las pilas de todos los hilos (flamegraph/speedscope) en <carpeta>/.bdt/perfil/")
+    return parser.parse_args(argv)
+
+def profiling_modes(args):
+    # --traza y --muestras ya implican --perfilado
+    modes = [mode for mode in ('traza', 'muestras') if getattr(args, mode)]
+    return modes or args.perfilado
+
+def run_worker(args):
+    engine = load_engine()
+    # La caché de páginas, el parser y la estructura de carpetas los fija la cola con la primera búsqueda
+    engine.setup_run({'parse_processes': args.procesos or 0, 'page_cache_size': 0, 'metrics_file': args.metricas, 'profiling': profiling_modes(args)}, args.carpeta)
+    try:
+        engine.open_work_queue(args.cola)
+        completed, failed = engine.run_worker(args.carpeta, args.hilos or engine.DOWNLOAD_WORKERS, args.alquiler or engine.WORK_QUEUE_LEASE)
+        print(f"\nTrabajador: {completed} descargados, {failed} fallidos")
+        engine.print_run_stats()
+    finally:
+        engine.finish_run()
+    return 1 if failed else 0
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.trabajador:
+        if not args.cola:
+            print("Error: --trabajador necesita --cola")
+            return 2
+        return run_worker(args)
+    try:
+        profiles = read_profiles(args.perfiles)
+        searches = [(args.perfil, search, 1) for search in args.busquedas]
+        if args.lista:
+            searches += read_search_list(args.lista, args.perfil)
+        if not searches:
+            raise ValueError("No hay ninguna búsqueda que hacer")
+        configs = []
+        for name, search, weight in searches:
+            profile = get_profile(profiles, name)
+            configs.append(dict(profile, search_url=search_url_for(search, profile), weight=weight))
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        return 2
+    profiling = profiling_modes(args)
+    for config in configs:
+        if args.motor:
+            config['engine'] = args.motor
+        if args.parser:
+            config['parser'] = args.parser
+        if args.procesos is not None:
+            config['parse_processes'] = args.procesos
+        if args.metricas:
+            config['metrics_file'] = args.metricas
+        if profiling:
+            config['profiling'] = profiling
+
+    engine = load_engine()
+    try:
+        check_run_settings(engine, configs)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 2
+    # Sesión, cachés, diario y limitadores se preparan una vez y valen para todas las búsquedas
+    engine.setup_run(configs[0], args.carpeta)
+    try:
+        return run_searches(engine, args, configs)
+    finally:
+        # También con Ctrl+C: el manejador de la señal solo avisa y sale, el cierre se hace aquí
+        engine.finish_run()
+
+def run_searches(engine, args, configs):
+    for config in configs:
+        if config is not configs[0]:
+            engine.configure_profile(config)
+            config['resolve_cache_path'] = configs[0]['resolve_cache_path']
+        config['sync'] = not args.completo and engine.journal_search_completed(config['search_url'])
+        note = ""
+        if config['sync']:
+            newest = engine.journal_newest_post_id(config['search_url'])
+            note = f" (solo posts nuevos, todo descargado hasta el #{newest})" if newest else " (solo posts nuevos)"
+        print(f"Búsqueda: {config['search_url']}{note}")
+
+    if args.cola:
+        engine.open_work_queue(args.cola)
+        progress = engine.run_coordinator(configs, wait=not args.no_esperar)
+        print(f"\nCola: {progress['done']} hechos, {progress['failed']} fallidos, {progress['pending'] + progress['leased']} sin terminar")
+        if progress['sin_recorrer']:
+            print(f"{progress['sin_recorrer']} búsquedas no se pudieron recorrer enteras")
+        return 1 if progress['failed'] or progress['sin_recorrer'] else 0
+
+    # Todas a la vez, turnándose según su peso y con un solo presupuesto de conexiones y ancho de banda
+    stats = engine.run_searches(configs, args.carpeta)
+    print()
+    for search in stats['busquedas']:
+        print(f"{search['search_url']}: {search['descargados']} descargados, {search['fallidos']} fallidos, {search['repetidos']} repetidos")
+    print(f"\nTotal: {stats['descargados']} descargados, {stats['fallidos']} fallidos en {len(configs)} búsquedas")
+    engine.print_run_stats()
+    return 1 if stats['fallidos'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
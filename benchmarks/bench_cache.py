@@ -0,0 +1,59 @@
+# Caché de páginas: la misma búsqueda tres veces contra un booru local, sin diario ni caché de
+# resolución (como una carpeta nueva) pero con la misma caché de páginas. La primera pasada la
+# llena, la segunda está dentro del TTL y no pide ninguna página, y en la tercera todo ha
+# caducado y se revalida con If-None-Match: el servidor contesta 304 sin cuerpo
+# Uso: python benchmarks/bench_cache.py [posts] [latencia_en_segundos]
+import os
+import sys
+import tempfile
+import time
+
+from bench_engines import reset_state, hash_folder
+from comun import load_engine
+from servidor_local import FakeBooru, site_config
+
+PASSES = ('vacía', 'fresca', 'caducada')
+
+def main():
+    posts = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    engine = load_engine()
+    engine.INITIAL_RATE = engine.MAX_RATE = 1e6
+    booru = FakeBooru(posts=posts, latency=latency)
+    base_url = booru.start()
+    ttl = dict(engine.PAGE_CACHE_TTL)
+
+    results = []
+    try:
+        for engine_name in ('threads', 'async'):
+            if engine_name == 'async' and engine.httpx is None:
+                print("async: httpx no está instalado, se omite")
+                continue
+            with tempfile.TemporaryDirectory() as cache_folder:
+                cache_path = os.path.join(cache_folder, engine.PAGE_CACHE_FILE)
+                for name in PASSES:
+                    reset_state(engine)
+                    engine.PAGE_CACHE_TTL.update(ttl if name != 'caducada' else dict.fromkeys(ttl, 0))
+                    engine.open_page_cache(cache_path)
+                    engine.page_cache_stats.update(aciertos=0, revalidadas=0, fallos=0)
+                    config = dict(site_config(base_url), engine=engine_name)
+                    with tempfile.TemporaryDirectory() as folder:
+                        before, before_bytes = booru.requests, booru.page_bytes
+                        start = time.perf_counter()
+                        completed, failed = engine.run_engine(config, folder)
+                        elapsed = time.perf_counter() - start
+                        results.append(hash_folder(folder))
+                    stats = engine.get_page_cache_stats()
+                    print(f"{engine_name:<8} {name:<9} {elapsed:6.2f} s  {booru.requests - before:4} peticiones  "
+                          f"{(booru.page_bytes - before_bytes) / 1024:7.1f} KiB de páginas  "
+                          f"{stats['aciertos']:3} aciertos {stats['revalidadas']:3} 304 {stats['fallos']:3} descargadas  {completed} archivos, {failed} fallos")
+                    engine.page_cache.close()
+    finally:
+        engine.PAGE_CACHE_TTL.update(ttl)
+        booru.stop()
+
+    identical = all(result == results[0] for result in results)
+    print("Archivos idénticos en todas las pasadas" if identical else "¡Los archivos NO coinciden entre pasadas!")
+
+if __name__ == '__main__':
+    main()
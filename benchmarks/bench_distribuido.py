@@ -0,0 +1,89 @@
+# Modo distribuido en una sola máquina: un coordinador llena la cola y varios procesos trabajadores
+# la vacían; al primero se le mata a mitad para comprobar que sus posts vuelven a la cola
+# Uso: python benchmarks/bench_distribuido.py [posts] [trabajadores] [latencia_en_segundos]
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from comun import ROOT
+from servidor_local import FakeBooru
+
+BDT = os.path.join(ROOT, 'BDT.py')
+LEASE = 3
+
+def write_profile(path, base_url):
+    host = base_url.split('//')[1]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'''[local]
+base_url = "{base_url}"
+search_url = "{base_url}/posts?tags={{tags}}&page={{{{page}}}}"
+file_link_selector = "a.post-preview-link"
+file_url_attribute = "href"
+download_link_selector = "li#post-info-size"
+
+[local.host_rates]
+"{host}" = 1000.0
+
+[local.host_connections]
+"{host}" = 64
+''')
+
+def bdt(*args):
+    return subprocess.Popen([sys.executable, BDT, *args], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def main():
+    posts = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    booru = FakeBooru(posts=posts, latency=latency)
+    base_url = booru.start()
+
+    with tempfile.TemporaryDirectory() as folder:
+        profiles = os.path.join(folder, 'perfiles.toml')
+        work_queue = os.path.join(folder, 'cola.sqlite3')
+        write_profile(profiles, base_url)
+        start = time.perf_counter()
+        coordinator = bdt('-f', profiles, '-p', 'local', 'mod1', '--cola', work_queue, '--no-esperar', '-o', os.path.join(folder, 'coordinador'))
+        # Damos tiempo a que se cree la cola antes de arrancar a los trabajadores
+        while not os.path.exists(work_queue):
+            time.sleep(0.05)
+        processes = [
+            bdt('--trabajador', '--cola', work_queue, '--alquiler', str(LEASE), '-o', os.path.join(folder, f'trabajador{i}'))
+            for i in range(workers)
+        ]
+        # Matamos al primero en cuanto tenga posts alquilados (si queda alguien para recogerlos)
+        victim = f'%-{processes[0].pid}'
+        while workers > 1 and processes[0].poll() is None:
+            try:
+                with sqlite3.connect(work_queue, timeout=60) as db:
+                    leased = db.execute("SELECT count(*) FROM items WHERE state = 'leased' AND worker LIKE ?", (victim,)).fetchone()[0]
+            except sqlite3.OperationalError:
+                leased = 0
+            if leased:
+                processes[0].send_signal(signal.SIGKILL)
+                break
+            time.sleep(0.05)
+        coordinator.wait()
+        for process in processes:
+            process.wait()
+        elapsed = time.perf_counter() - start
+        booru.stop()
+
+        with sqlite3.connect(work_queue) as db:
+            states = dict(db.execute('SELECT state, count(*) FROM items GROUP BY state').fetchall())
+            retried = db.execute('SELECT count(*) FROM items WHERE attempts > 1').fetchone()[0]
+        files = set()
+        for i in range(workers):
+            worker_folder = os.path.join(folder, f'trabajador{i}')
+            if os.path.isdir(worker_folder):
+                files.update(name for name in os.listdir(worker_folder) if not name.startswith('.'))
+    killed = " (uno muerto a mitad)" if workers > 1 else ""
+    print(f"{workers} trabajadores{killed}: {elapsed:.2f} s, cola {states}, {retried} reintentados tras caducar")
+    print("Todos los posts descargados" if len(files) == posts else f"¡Faltan archivos! {len(files)} de {posts}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# Compara el motor de hilos con el motor async contra un booru local con latencia
+# Uso: python benchmarks/bench_engines.py [posts] [latencia_en_segundos]
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+from comun import load_engine
+from servidor_local import FakeBooru, site_config
+
+def reset_state(engine):
+    # Cada pasada empieza sin cachés ni diario, como una ejecución nueva
+    engine.resolve_cache.clear()
+    engine.rate_limiters.clear()
+    engine.journal = None
+    engine.page_cache = None
+
+def hash_folder(folder):
+    digests = {}
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        # El almacén de .bdt/ no cuenta, solo lo que ve el usuario
+        if os.path.isdir(path):
+            continue
+        with open(path, 'rb') as f:
+            digests[name] = hashlib.sha256(f.read()).hexdigest()
+    return digests
+
+def main():
+    posts = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    engine = load_engine()
+    # Aquí se comparan los motores, no el limitador: lo dejamos sin techo
+    engine.INITIAL_RATE = engine.MAX_RATE = 1e6
+    booru = FakeBooru(posts=posts, latency=latency)
+    base_url = booru.start()
+
+    results = {}
+    try:
+        for name in ('threads', 'async'):
+            if name == 'async' and engine.httpx is None:
+                print("async: httpx no está instalado, se omite")
+                continue
+            reset_state(engine)
+            config = dict(site_config(base_url), engine=name)
+            with tempfile.TemporaryDirectory() as folder:
+                start = time.perf_counter()
+                completed, failed = engine.run_engine(config, folder)
+                elapsed = time.perf_counter() - start
+                results[name] = hash_folder(folder)
+            print(f"{name:<8} {elapsed:7.2f} s  {completed} archivos, {failed} fallos, {completed / elapsed:7.1f} archivos/s")
+    finally:
+        booru.stop()
+
+    if len(results) == 2:
+        identical = results['threads'] == results['async']
+        print("Archivos idénticos en ambos motores" if identical else "¡Los archivos NO coinciden entre motores!")
+
+if __name__ == '__main__':
+    main()
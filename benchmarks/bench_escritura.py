@@ -0,0 +1,69 @@
+# Compara el bucle de escritura de antes (iter_content de 8 KB, una actualización de la barra por
+# trozo) con el de download_file contra un servidor local, en MB/s de reloj y MB/s por núcleo
+# Uso: python benchmarks/bench_escritura.py [tamaño_en_MB] [repeticiones]
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+from tqdm import tqdm
+
+from comun import load_engine
+from servidor_local import FakeBooru
+
+def old_download(engine, url, path):
+    # El bucle de download_file antes de este cambio, con el mismo hash y la misma barra
+    hashers = (hashlib.sha256(), hashlib.md5())
+    with engine.get_session().get(url, stream=True) as r, open(path, 'wb') as f:
+        r.raise_for_status()
+        with tqdm(total=int(r.headers.get('content-length', 0)), unit='iB', unit_scale=True, disable=True) as bar:
+            for chunk in r.iter_content(chunk_size=8192):
+                if chunk:
+                    size = f.write(chunk)
+                    for hasher in hashers:
+                        hasher.update(chunk)
+                    engine.update_progress(bar, size)
+    return path
+
+def new_download(engine, url, folder):
+    with tqdm(unit='iB', unit_scale=True, disable=True) as bar:
+        return engine.download_file(url, folder, progress=bar)
+
+def measure(function):
+    start, cpu = time.perf_counter(), time.thread_time()
+    path = function()
+    # El servidor va en otros hilos; thread_time solo cuenta el que descarga
+    return path, time.perf_counter() - start, time.thread_time() - cpu
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    engine = load_engine()
+    engine.INITIAL_RATE = engine.MAX_RATE = 1e6
+    # Aquí se mide el bucle de escritura de una conexión, sin segmentos
+    engine.SEGMENTS = 1
+    booru = FakeBooru(posts=1, file_size=size_mb * 1024 * 1024)
+    url = booru.start() + booru.media_path(1)
+    expected = hashlib.sha256(booru.media[booru.md5_by_id[1]]).hexdigest()
+    try:
+        for name in ('antes', 'ahora'):
+            best = None
+            for _ in range(repeat):
+                with tempfile.TemporaryDirectory() as folder:
+                    if name == 'antes':
+                        path, wall, cpu = measure(lambda: old_download(engine, url, os.path.join(folder, 'archivo')))
+                    else:
+                        engine.journal = None
+                        path, wall, cpu = measure(lambda: new_download(engine, url, folder))
+                    if engine.file_sha256(path) != expected:
+                        print(f"{name}: ¡el archivo descargado no coincide!")
+                if best is None or wall < best[0]:
+                    best = (wall, cpu)
+            wall, cpu = best
+            print(f"{name:<6} {size_mb / wall:8.0f} MB/s  {size_mb / cpu:8.0f} MB/s por núcleo")
+    finally:
+        booru.stop()
+
+if __name__ == '__main__':
+    main()
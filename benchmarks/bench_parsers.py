@@ -0,0 +1,47 @@
+# Compara los backends de parseo HTML sobre páginas guardadas en fixtures/
+# Uso: python benchmarks/bench_parsers.py [repeticiones]
+import sys
+import time
+
+from comun import load_engine, read_fixture
+
+LISTING_SELECTOR = 'a.post-preview-link'
+LISTING_ATTRIBUTE = 'href'
+DOWNLOAD_SELECTOR = 'li#post-info-size'
+BASE_URL = 'https://booru.example.com'
+
+def bench(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    engine = load_engine()
+    listing = read_fixture('listado.html')
+    post = read_fixture('post.html')
+
+    reference = None
+    print(f"{'backend':<12} {'listado (ms)':>13} {'post (ms)':>10} {'paginación (ms)':>16}")
+    for backend in engine.PARSER_PREFERENCE:
+        if not engine.parser_available(backend):
+            print(f"{backend:<12} {'no instalado':>13}")
+            continue
+        result = (
+            engine.parse_file_urls(listing, LISTING_SELECTOR, LISTING_ATTRIBUTE, backend),
+            engine.parse_download_url(post, DOWNLOAD_SELECTOR, BASE_URL, backend),
+            engine.parse_total_pages(listing, backend),
+        )
+        # Todos los backends tienen que sacar exactamente lo mismo
+        if reference is None:
+            reference = result
+        elif result != reference:
+            print(f"{backend}: el resultado no coincide con el de los demás backends")
+        listing_time = bench(lambda: engine.parse_file_urls(listing, LISTING_SELECTOR, LISTING_ATTRIBUTE, backend), repeat)
+        post_time = bench(lambda: engine.parse_download_url(post, DOWNLOAD_SELECTOR, BASE_URL, backend), repeat)
+        pages_time = bench(lambda: engine.parse_total_pages(listing, backend), repeat)
+        print(f"{backend:<12} {listing_time * 1000:>13.2f} {post_time * 1000:>10.2f} {pages_time * 1000:>16.2f}")
+
+if __name__ == '__main__':
+    main()
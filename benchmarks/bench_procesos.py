@@ -0,0 +1,62 @@
+# Mide cuánto escala el análisis de HTML con la pool de procesos frente a hacerlo en los hilos
+# Uso: python benchmarks/bench_procesos.py [páginas] [backend]
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from comun import load_engine, read_fixture
+
+LISTING_SELECTOR = 'a.post-preview-link'
+LISTING_ATTRIBUTE = 'href'
+DOWNLOAD_SELECTOR = 'li#post-info-size'
+BASE_URL = 'https://booru.example.com'
+THREADS = 16
+
+def parse_page(engine, page):
+    # Lo mismo que hacen los hilos del pipeline con cada página descargada
+    kind, html = page
+    if kind == 'listado':
+        return engine.parse_html(engine.parse_file_urls, html, LISTING_SELECTOR, LISTING_ATTRIBUTE)
+    return engine.parse_html(engine.parse_download_url, html, DOWNLOAD_SELECTOR, BASE_URL)
+
+def run(engine, pages, processes):
+    engine.start_parse_pool(processes)
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(THREADS) as executor:
+            results = list(executor.map(lambda page: parse_page(engine, page), pages))
+        return time.perf_counter() - start, results
+    finally:
+        engine.stop_parse_pool()
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    engine = load_engine()
+    # Por defecto bs4 con html.parser, que es el caso que más sufre con el GIL
+    engine.set_parser_backend(sys.argv[2] if len(sys.argv) > 2 else 'html.parser')
+    listing = read_fixture('listado.html')
+    post = read_fixture('post.html')
+    # Cada listado lleva un marcador distinto para comprobar que cada página recibe lo suyo
+    pages = []
+    for i in range(count):
+        if i % 2:
+            pages.append(('post', post))
+        else:
+            pages.append(('listado', listing.replace('href="/posts/1000?', f'href="/posts/1000?n={i}&', 1)))
+
+    cores = os.cpu_count() or 1
+    levels = [0] + sorted({n for n in (1, 2, 4, 8, 16, cores) if n <= cores})
+    print(f"{count} páginas con {engine.get_parser_backend()}, {THREADS} hilos, {cores} núcleos")
+    reference = None
+    base = None
+    for processes in levels:
+        elapsed, results = run(engine, pages, processes)
+        if reference is None:
+            reference, base = results, elapsed
+        ok = "" if results == reference else "  (¡el resultado no coincide!)"
+        label = "en hilos" if processes == 0 else f"{processes} procesos"
+        print(f"{label:<12} {elapsed:6.2f} s  {count / elapsed:7.1f} páginas/s  x{base / elapsed:.2f}{ok}")
+
+if __name__ == '__main__':
+    main()
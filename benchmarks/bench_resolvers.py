@@ -0,0 +1,51 @@
+# Compara el resolver HTML (listado + una visita a cada post), el HTML que saca la URL del archivo
+# del propio listado y el de la API JSON contra un booru local con latencia: peticiones, tiempo
+# y que los archivos salgan iguales
+# Uso: python benchmarks/bench_resolvers.py [posts] [latencia_en_segundos]
+import sys
+import tempfile
+import time
+
+from bench_engines import reset_state, hash_folder
+from comun import load_engine
+from servidor_local import FakeBooru, site_config
+
+VARIANTS = {
+    'html': {},
+    'listado': {'listing_file_attribute': 'data-file-url'},
+    'danbooru': {'resolver': 'danbooru'},
+}
+
+def main():
+    posts = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    engine = load_engine()
+    engine.INITIAL_RATE = engine.MAX_RATE = 1e6
+    booru = FakeBooru(posts=posts, latency=latency)
+    base_url = booru.start()
+
+    results = {}
+    try:
+        for engine_name in ('threads', 'async'):
+            if engine_name == 'async' and engine.httpx is None:
+                print("async: httpx no está instalado, se omite")
+                continue
+            for variant, overrides in VARIANTS.items():
+                reset_state(engine)
+                config = dict(site_config(base_url), engine=engine_name, **overrides)
+                with tempfile.TemporaryDirectory() as folder:
+                    before = booru.requests
+                    start = time.perf_counter()
+                    completed, failed = engine.run_engine(config, folder)
+                    elapsed = time.perf_counter() - start
+                    results[engine_name, variant] = hash_folder(folder)
+                print(f"{engine_name:<8} {variant:<9} {elapsed:7.2f} s  {booru.requests - before:5} peticiones  {completed} archivos, {failed} fallos")
+    finally:
+        booru.stop()
+
+    reference = next(iter(results.values()), None)
+    identical = all(result == reference for result in results.values())
+    print("Archivos idénticos con todos los resolvers" if identical else "¡Los archivos NO coinciden entre resolvers!")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# Compara varias búsquedas una detrás de otra con las mismas búsquedas a la vez en el planificador
+# Uso: python benchmarks/bench_scheduler.py [posts] [latencia_en_segundos] [motor]
+import sys
+import tempfile
+import time
+
+from comun import load_engine
+from servidor_local import FakeBooru, site_config
+from bench_engines import reset_state
+
+# Se solapan: un post con ID múltiplo de 6 sale en mod2 y en mod3
+TAGS = ('mod2', 'mod3', 'mod5', 'mod7')
+
+def main():
+    posts = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    engine_name = sys.argv[3] if len(sys.argv) > 3 else 'threads'
+    engine = load_engine()
+    engine.INITIAL_RATE = engine.MAX_RATE = 1e6
+    booru = FakeBooru(posts=posts, latency=latency)
+    base_url = booru.start()
+    configs = [dict(site_config(base_url, tag), engine=engine_name) for tag in TAGS]
+
+    try:
+        reset_state(engine)
+        with tempfile.TemporaryDirectory() as folder:
+            requests_before = booru.requests
+            start = time.perf_counter()
+            completed = sum(engine.run_engine(dict(config), folder)[0] for config in configs)
+            elapsed = time.perf_counter() - start
+        print(f"{'secuencial':<12} {elapsed:7.2f} s  {completed} archivos, {booru.requests - requests_before} peticiones")
+
+        reset_state(engine)
+        with tempfile.TemporaryDirectory() as folder:
+            requests_before = booru.requests
+            start = time.perf_counter()
+            stats = engine.run_searches([dict(config) for config in configs], folder)
+            elapsed = time.perf_counter() - start
+        print(f"{'planificador':<12} {elapsed:7.2f} s  {stats['descargados']} archivos, "
+              f"{booru.requests - requests_before} peticiones, {stats['repetidos']} repetidos")
+    finally:
+        booru.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Descarga un archivo grande de un servidor que limita cada conexión, de una pieza y por segmentos,
+# y comprueba que una descarga por segmentos interrumpida se reanuda bien
+# Uso: python benchmarks/bench_segmentos.py [tamaño_en_MB] [MB/s_por_conexión]
+import hashlib
+import sys
+import tempfile
+import threading
+import time
+
+from tqdm import tqdm
+
+from comun import load_engine
+from servidor_local import FakeBooru
+
+def download(engine, url, folder):
+    with tqdm(unit='iB', unit_scale=True, disable=True) as bar:
+        return engine.download_file(url, folder, progress=bar)
+
+def check(engine, path, expected):
+    return "ok" if path and engine.file_sha256(path) == expected else "¡NO COINCIDE!"
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    throttle_mb = float(sys.argv[2]) if len(sys.argv) > 2 else 16
+    engine = load_engine()
+    engine.INITIAL_RATE = engine.MAX_RATE = 1e6
+    engine.SEGMENT_MIN_SIZE = 1024 * 1024
+    booru = FakeBooru(posts=1, file_size=size_mb * 1024 * 1024, throttle=int(throttle_mb * 1024 * 1024))
+    base_url = booru.start()
+    url = base_url + booru.media_path(1)
+    host = engine.get_host(url)
+    expected = hashlib.sha256(booru.media[booru.md5_by_id[1]]).hexdigest()
+    print(f"{size_mb} MB a {throttle_mb:g} MB/s por conexión")
+    try:
+        for segments in (1, 2, 4, 8):
+            # Los segmentos caben en el límite de conexiones del host, no lo saltan
+            engine.SEGMENTS = segments
+            engine.HOST_CONNECTIONS[host] = segments
+            engine.host_semaphores.clear()
+            with tempfile.TemporaryDirectory() as folder:
+                start = time.perf_counter()
+                path = download(engine, url, folder)
+                elapsed = time.perf_counter() - start
+                print(f"{segments} segmentos  {elapsed:6.2f} s  {size_mb / elapsed:7.1f} MB/s  {check(engine, path, expected)}")
+
+        # Cortamos a mitad y reanudamos: cada segmento sigue desde donde iba
+        with tempfile.TemporaryDirectory() as folder:
+            timer = threading.Timer(size_mb / throttle_mb / engine.SEGMENTS / 2, engine.stop_event.set)
+            timer.start()
+            path = download(engine, url, folder)
+            done = engine.part_bytes_done(engine.part_path_for(url, folder))
+            engine.stop_event.clear()
+            requests_before = booru.requests
+            path = download(engine, url, folder)
+            print(f"Interrumpida con {done / 1024 / 1024:.1f} MB bajados, reanudada en {booru.requests - requests_before} peticiones: {check(engine, path, expected)}")
+    finally:
+        booru.stop()
+
+if __name__ == '__main__':
+    main()
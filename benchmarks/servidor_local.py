@@ -0,0 +1,187 @@
+# Booru de mentira para los benchmarks: listados, páginas de post, API JSON y archivos,
+# con latencia configurable y soporte de HEAD, Range y ETag como un CDN de verdad (también en las
+# páginas, que contestan 304 a If-None-Match); con throttle cada conexión manda los archivos a como
+# mucho esos bytes/s, como los CDN que limitan por conexión
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+PER_PAGE = 20
+
+def make_media(post_id, size):
+    seed = hashlib.sha256(str(post_id).encode()).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+class BenchServer(ThreadingHTTPServer):
+    # La cola de conexiones por defecto (5) se desborda con cientos de clientes a la vez
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clientes que cuelgan a mitad de un archivo (segmentos, cancelaciones) no son un fallo
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+class FakeBooru:
+    def __init__(self, posts=200, file_size=256 * 1024, latency=0.0, throttle=0):
+        self.posts = posts
+        self.latency = latency
+        self.throttle = throttle
+        self.media = {}
+        self.md5_by_id = {}
+        for post_id in range(1, posts + 1):
+            data = make_media(post_id, file_size + post_id)
+            md5 = hashlib.md5(data).hexdigest()
+            self.media[md5] = data
+            self.md5_by_id[post_id] = md5
+        self.requests = 0
+        # Bytes de páginas HTML/JSON enviados, para medir lo que ahorran las revalidaciones
+        self.page_bytes = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def tag_ids(self, tag=None):
+        # La etiqueta 'modN' son los posts cuyo ID es múltiplo de N; sin etiqueta, todos
+        ids = range(self.posts, 0, -1)
+        match = re.fullmatch(r'mod(\d+)', tag or '')
+        if match:
+            ids = [post_id for post_id in ids if post_id % int(match.group(1)) == 0]
+        return list(ids)
+
+    def total_pages(self, tag=None):
+        return max((len(self.tag_ids(tag)) + PER_PAGE - 1) // PER_PAGE, 1)
+
+    def page_ids(self, page, tag=None, per_page=PER_PAGE):
+        return self.tag_ids(tag)[(page - 1) * per_page:page * per_page]
+
+    def media_path(self, post_id):
+        md5 = self.md5_by_id[post_id]
+        return f'/data/{md5[:2]}/{md5}.jpg'
+
+    def start(self):
+        booru = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, code, body, content_type='text/html', headers=None, throttle=0):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if self.command == 'HEAD':
+                    return
+                if not throttle:
+                    self.wfile.write(body)
+                    return
+                body = memoryview(body)
+                step = max(throttle // 20, 1)
+                for start in range(0, len(body), step):
+                    self.wfile.write(body[start:start + step])
+                    time.sleep(step / throttle)
+
+            def send_page(self, body, content_type='text/html'):
+                etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                with booru.lock:
+                    booru.page_bytes += len(body)
+                self.send(200, body, content_type, {'ETag': etag})
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                with booru.lock:
+                    booru.requests += 1
+                if booru.latency:
+                    time.sleep(booru.latency)
+                path = self.path
+                match = re.match(r'/posts\?(?:tags=(\w*)&)?page=(\d+)', path)
+                if match:
+                    return self.send_page(booru.listing(int(match.group(2)), match.group(1)).encode())
+                match = re.match(r'/posts/(\d+)$', path)
+                if match and int(match.group(1)) in booru.md5_by_id:
+                    return self.send_page(booru.post(int(match.group(1))).encode())
+                # API al estilo Danbooru: listados con tags, page y limit, recuento y posts sueltos
+                query = {key: values[0] for key, values in parse_qs(urlparse(path).query).items()}
+                host = self.headers.get('Host')
+                if path.startswith('/posts.json?'):
+                    page, limit = int(query.get('page', 1)), int(query.get('limit', PER_PAGE))
+                    posts = [booru.api_post(post_id, host) for post_id in booru.page_ids(page, query.get('tags'), limit)]
+                    return self.send_page(json.dumps(posts).encode(), 'application/json')
+                if path.startswith('/counts/posts.json?'):
+                    count = len(booru.tag_ids(query.get('tags')))
+                    return self.send_page(json.dumps({'counts': {'posts': count}}).encode(), 'application/json')
+                match = re.match(r'/posts/(\d+)\.json', path)
+                if match and int(match.group(1)) in booru.md5_by_id:
+                    return self.send_page(json.dumps(booru.api_post(int(match.group(1)), host)).encode(), 'application/json')
+                match = re.match(r'/data/\w\w/(\w+)\.jpg', path)
+                if match and match.group(1) in booru.media:
+                    return self.send_media(booru.media[match.group(1)], match.group(1))
+                self.send(404, b'not found')
+
+            def send_media(self, data, md5):
+                headers = {'ETag': f'"{md5}"', 'Accept-Ranges': 'bytes'}
+                match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+                if match:
+                    start = int(match.group(1))
+                    end = int(match.group(2)) if match.group(2) else len(data) - 1
+                    headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+                    return self.send(206, data[start:end + 1], 'image/jpeg', headers, booru.throttle)
+                self.send(200, data, 'image/jpeg', headers, booru.throttle)
+
+        self.server = BenchServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def listing(self, page, tag=None):
+        previews = ''.join(
+            f'<article class="post-preview" data-id="{post_id}" data-file-url="{self.media_path(post_id)}">'
+            f'<a class="post-preview-link" href="/posts/{post_id}"><img src="/thumb/{post_id}.jpg"></a></article>'
+            for post_id in self.page_ids(page, tag)
+        )
+        paginator = ''.join(f'<a href="/posts?page={number}">{number}</a>' for number in range(1, self.total_pages(tag) + 1))
+        return f'<html><body><div class="posts">{previews}</div><div class="paginator">{paginator}</div></body></html>'
+
+    def post(self, post_id):
+        return (
+            '<html><body><section id="post-information"><ul>'
+            f'<li id="post-info-size"><a href="{self.media_path(post_id)}">descargar</a></li>'
+            '</ul></section></body></html>'
+        )
+
+    def api_post(self, post_id, host):
+        return {
+            'id': post_id,
+            'md5': self.md5_by_id[post_id],
+            'file_size': len(self.media[self.md5_by_id[post_id]]),
+            'file_url': f'http://{host}{self.media_path(post_id)}',
+        }
+
+def site_config(base_url, tag=None, resolver='html'):
+    return {
+        'resolver': resolver,
+        'base_url': base_url,
+        'search_url': base_url + (f'/posts?tags={tag}&page={{{{page}}}}' if tag else '/posts?page={{page}}'),
+        'file_link_selector': 'a.post-preview-link',
+        'file_url_attribute': 'href',
+        'download_link_selector': 'li#post-info-size',
+    }
@@ -1,20 +1,275 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from bs4 import BeautifulSoup
+import soupsieve
 import os
 from tqdm import tqdm
 import re
+import string
 import time
+import random
 import signal
 import sys
 import math
-from concurrent.futures import ThreadPoolExecutor
+import json
+import email.utils
+import hashlib
+import shutil
+import sqlite3
+import zlib
+import threading
+import socket
+import queue
+import asyncio
+import functools
+import multiprocessing
+import contextvars
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, asynccontextmanager
+from urllib.parse import urlparse, urlencode, parse_qs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Parsers HTML opcionales, más rápidos que html.parser
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    SelectolaxParser = None
+try:
+    import httpx
+except ImportError:
+    httpx = None
+try:
+    import lxml.html as lxml_html
+except ImportError:
+    lxml_html = None
+try:
+    from lxml.cssselect import CSSSelector
+except ImportError:
+    CSSSelector = None
+# Reflinks (copias que comparten bloques) solo en Linux con btrfs/XFS
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Configuración global
 MAX_RETRIES = 3
-RETRY_DELAY = 5
+# Espera base de los reintentos; se dobla en cada intento (con jitter) hasta RETRY_MAX_DELAY
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 60
+# Errores HTTP que merece la pena reintentar; el resto de 4xx (404, 403...) no van a cambiar
+RETRY_STATUS = (408, 425, 429)
+
+# Limitador por host: cubo de tokens con AIMD. El ritmo sube poco a poco mientras el servidor
+# responde bien y se recorta a la mitad con 429/503, timeouts o si la latencia se dispara
+INITIAL_RATE = 8.0
+MIN_RATE = 0.5
+MAX_RATE = 200.0
+HOST_RATES = {}
+RATE_INCREASE = 1.0
+RATE_DECREASE = 0.5
+THROTTLE_STATUS = (429, 503)
+# Latencia media por encima de LATENCY_THRESHOLD veces la mejor vista = el servidor va saturado
+LATENCY_THRESHOLD = 3.0
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+# Ancho de banda máximo en bytes/s por host; la clave '*' limita el total de todas las descargas
+BANDWIDTH_LIMITS = {}
+bandwidth_buckets = {}
+
+# Escritura de las descargas: se lee con readinto sobre un único búfer reutilizado, en trozos
+# que crecen mientras la red los llene rápido y se achican si tarda (para que Ctrl+C responda)
+READ_CHUNK_MIN = 64 * 1024
+READ_CHUNK_MAX = 4 * 1024 * 1024
+READ_CHUNK_SLOW = 0.25
+# Un búfer por hilo, reservado la primera vez: sin él cada intento y cada segmento pedía 4 MB a cero
+read_buffers = threading.local()
+# La barra de progreso se actualiza como mucho cada tanto, no en cada trozo
+PROGRESS_INTERVAL = 0.2
+# A partir de este tamaño se reserva el archivo entero de una vez, para que no se fragmente
+PREALLOCATE_MIN = 64 * 1024 * 1024
+# Archivos grandes en servidores que aceptan rangos: se bajan en varios segmentos a la vez, para
+# los CDN que limitan la velocidad de cada conexión. Cada segmento ocupa un hueco de HOST_CONNECTIONS
+SEGMENTS = 4
+SEGMENT_MIN_SIZE = 32 * 1024 * 1024
+
+# Métodos para averiguar el tamaño de un archivo, del más barato al más caro
+SIZE_PROBE_METHODS = ('head', 'range', 'stream')
+
+# Método de sondeo que funciona en cada host, para no repetir los que fallan
+host_probe_methods = {}
+host_probe_lock = threading.Lock()
+
+# Caché de resolución: URL del post -> URL del archivo, tamaño, ETag y Last-Modified
+RESOLVE_CACHE_FILE = 'resolve_cache.jsonl'
+RESOLVE_CACHE_TTL = 7 * 24 * 3600
+resolve_cache = {}
+resolve_cache_lock = threading.Lock()
+
+# Caché HTTP de páginas (listados, posts y respuestas de las APIs), comprimida en un SQLite.
+# Mientras no pase el TTL de su ruta una página se sirve sin preguntar; después se revalida
+# con If-None-Match/If-Modified-Since y si no ha cambiado el servidor contesta 304 sin cuerpo.
+# Los posts casi nunca cambian; la primera página de un listado es la que recibe los nuevos
+PAGE_CACHE_FILE = 'pages.sqlite3'
+PAGE_CACHE_MAX_SIZE = 256 * 1024 * 1024
+PAGE_CACHE_TTL = {'post': 30 * 24 * 3600, 'count': 300, 'first_page': 60, 'page': 600}
+page_cache = None
+page_cache_size = 0
+page_cache_max_size = PAGE_CACHE_MAX_SIZE
+page_cache_lock = threading.Lock()
+page_cache_stats = {'aciertos': 0, 'revalidadas': 0, 'fallos': 0}
+
+# Descargas en paralelo: número de hilos y conexiones simultáneas por host
+DOWNLOAD_WORKERS = 8
+DEFAULT_HOST_CONNECTIONS = 4
+HOST_CONNECTIONS = {}
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+progress_lock = threading.Lock()
+
+# Pipeline por etapas: hilos que resuelven posts y tamaño de las colas entre etapas
+CRAWL_WORKERS = 4
+RESOLVE_WORKERS = 8
+QUEUE_SIZE = 64
+# Con varias búsquedas a la vez, cuántas se recorren en paralelo (el resto espera turno)
+ACTIVE_SEARCHES = 8
+
+# Motor: 'threads' (hilos + requests) o 'async' (asyncio + httpx, opcional)
+ENGINE = 'threads'
+ASYNC_CONCURRENCY = 1000
+# Conexiones abiertas del cliente httpx; su pool recorre todas las conexiones en cada
+# petición, así que con miles se vuelve cuadrático: mejor menos conexiones y más cola
+ASYNC_CONNECTIONS = 100
+# Claves que valen para toda la ejecución: con varias búsquedas se leen de la primera configuración,
+# así que BDT.py exige que todos los perfiles coincidan en ellas
+RUN_KEYS = (
+    'engine', 'parser', 'parse_processes', 'page_cache_size', 'layout', 'md5_patterns',
+    'metrics_file', 'metrics_interval', 'profiling', 'download_workers', 'resolve_workers',
+    'queue_size', 'active_searches', 'async_concurrency', 'async_connections',
+)
+
+# Sesión HTTP compartida por todos los hilos, para reutilizar conexiones (keep-alive)
+POOL_CONNECTIONS = 16
+POOL_MAXSIZE = 32
+DEFAULT_HEADERS = {'User-Agent': 'booru-downloader-tool'}
+http_session = None
+http_session_lock = threading.Lock()
+connection_stats = {'peticiones': 0, 'nuevas': 0}
+connection_stats_lock = threading.Lock()
+
+# Métricas por etapa (recuento, listado, post, sondeo, descarga) para vigilar ejecuciones largas:
+# respuestas por host y código, latencias, bytes, reintentos, colas y archivos por segundo.
+# Cada METRICS_INTERVAL segundos se escriben en metrics_file: en el formato textfile de
+# Prometheus si acaba en .prom (para el textfile collector de node_exporter) y en JSON si no
+METRICS_INTERVAL = 15
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+ROUTE_STAGES = {'count': 'recuento', 'first_page': 'listado', 'page': 'listado', 'post': 'post'}
+current_stage = contextvars.ContextVar('current_stage', default='otros')
+metrics = {'respuestas': {}, 'latencia': {}, 'duracion': {}, 'bytes': {}, 'reintentos': {}, 'posts': {}}
+metrics_lock = threading.Lock()
+metrics_queues = {}
+metrics_started = time.time()
+metrics_path = None
+metrics_thread = None
+metrics_stop = threading.Event()
+
+# Perfilado (--perfilado): tiempo real y de CPU de cada etapa, exclusivo (lo que tarda la escritura
+# no cuenta en la descarga que la contiene), para ver si una ejecución lenta espera a la red, al
+# análisis del HTML o al disco. 'traza' guarda además una línea de tiempo de cada etapa y petición
+# por hilo (formato Chrome trace, se abre en chrome://tracing, Perfetto o speedscope) y 'muestras'
+# un muestreo de las pilas de todos los hilos (formato collapsed de flamegraph.pl y speedscope)
+PROFILE_MODES = ('etapas', 'traza', 'muestras')
+PROFILE_FOLDER = 'perfil'
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_MAX_EVENTS = 1_000_000
+# A qué espera cada etapa, para el resumen final
+PROFILE_BOUND = {
+    'analisis': 'el análisis del HTML',
+    'escritura': 'el disco',
+    'espera': 'un turno de los límites por host (host_connections, host_rates)',
+}
+profiling = None
+profile_folder = None
+profile_totals = {}
+profile_events = []
+profile_lanes = {}
+profile_samples = {}
+profile_lock = threading.Lock()
+profile_started = None
+profile_cpu_started = None
+profile_sampler = None
+profile_sampler_stop = threading.Event()
+current_frame = contextvars.ContextVar('current_frame', default=None)
+
+# Hosts que aceptan (o no) peticiones con Range, para reanudar descargas
+host_range_support = {}
+host_range_lock = threading.Lock()
+stop_event = threading.Event()
+
+# Parser HTML: 'auto' elige el más rápido de los instalados, en este orden
+PARSER_PREFERENCE = ('selectolax', 'lxml', 'bs4-lxml', 'html.parser')
+parser_backend = None
+parser_lock = threading.Lock()
+compiled_selectors = {}
+# En el listado, el atributo con la URL del archivo puede estar en el enlace o en un contenedor
+# cercano (<article data-file-url> en Danbooru/e621); hasta cuántos niveles se sube a buscarlo
+LISTING_ANCESTORS = 3
+# Procesos para analizar el HTML fuera del GIL (0 = en el mismo hilo que descarga la página).
+# La red sigue en hilos o asyncio; a los procesos solo va el HTML y vuelven las URLs
+PARSE_PROCESSES = 0
+parse_pool = None
+
+# Diario en disco con el estado de cada post, para reanudar y repetir búsquedas sin rehacer trabajo
+JOURNAL_FILE = 'journal.sqlite3'
+JOURNAL_STATES = ('discovered', 'resolved', 'downloading', 'done', 'failed')
+journal = None
+journal_lock = threading.Lock()
+
+# Modo distribuido: cola de trabajo en un SQLite compartido; los trabajadores alquilan posts
+# durante WORK_QUEUE_LEASE segundos y si se caen el alquiler caduca y otro los recoge
+WORK_QUEUE_LEASE = 300
+WORK_QUEUE_BATCH = 4
+WORK_QUEUE_MAX_ATTEMPTS = 5
+WORK_QUEUE_POLL = 2
+# Claves de la configuración que solo tienen sentido en la máquina que las puso
+WORK_QUEUE_LOCAL_KEYS = ('resolve_cache_path', 'sync')
+work_queue_db = None
+work_queue_lock = threading.Lock()
+
+# Almacén por contenido: cada archivo se guarda una sola vez en .bdt/objects/<sha256[:2]>/<sha256>
+# y en la carpeta de descarga solo hay enlaces a él, colocados según output_layout
+STATE_FOLDER = '.bdt'
+OBJECTS_FOLDER = 'objects'
+LAYOUT_FIELDS = ('filename', 'name', 'ext', 'sha256', 'md5')
+DEFAULT_LAYOUT = '{filename}'
+FICLONE = 0x40049409
+output_layout = DEFAULT_LAYOUT
+
+# Casi todos los boorus ponen el MD5 del archivo en su nombre (/images/ab/cd/<md5>.jpg,
+# __tags__<md5>.png); el primer grupo de cada patrón es el MD5. Las muestras redimensionadas
+# llevan el MD5 del original, por eso solo se aceptan nombres que acaban en el MD5
+MD5_URL_PATTERNS = (
+    r'/([0-9a-f]{32})\.\w+$',
+    r'__([0-9a-f]{32})\.\w+$',
+)
+md5_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in MD5_URL_PATTERNS]
+
+class DownloadCancelled(Exception):
+    pass
+
+class RangeMismatch(Exception):
+    pass
+
+class PageFetchError(Exception):
+    # Una página de la búsqueda no se pudo leer: la búsqueda no se da por recorrida
+    pass
 
 def signal_handler(sig, frame):
     print("\nInterrupción detectada. Finalizando el programa...")
+    # Avisamos a los hilos de descarga para que paren y dejen sus .part para reanudar; el cierre lo
+    # hace el finally de main, ya fuera de cualquier candado que tuviera el hilo principal
+    stop_event.set()
     sys.exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
@@ -35,60 +290,1644 @@ def get_user_input():
         'download_link_selector': download_link_selector
     }
 
-def make_request(url, retries=MAX_RETRIES):
+def make_request(url, retries=MAX_RETRIES, headers=None):
     for attempt in range(retries):
         try:
-            response = requests.get(url, timeout=30)
+            with host_slot(url):
+                response = limited_request('get', url, headers=headers)
             response.raise_for_status()
             return response
         except requests.RequestException as e:
-            if attempt < retries - 1:
-                print(f"Error al acceder a {url}: {e}. Reintentando en {RETRY_DELAY} segundos...")
-                time.sleep(RETRY_DELAY)
+            if attempt < retries - 1 and is_retryable(e) and not stop_event.is_set():
+                record_metric_retry()
+                delay = retry_delay(attempt, e)
+                print(f"Error al acceder a {url}: {e}. Reintentando en {delay:.1f} segundos...")
+                stop_event.wait(delay)
             else:
-                print(f"Error al acceder a {url} después de {retries} intentos: {e}")
+                print(f"Error al acceder a {url} después de {attempt + 1} intentos: {e}")
                 return None
     return None
 
-def get_total_pages(url):
-    response = make_request(url.replace('{{page}}', '1'))
-    if not response:
-        return 1
-    soup = BeautifulSoup(response.text, 'html.parser')
-    pagination_links = soup.find_all('a', href=re.compile(r'\?page=\d+'))
-    if pagination_links:
-        page_numbers = [int(re.search(r'\d+', link['href']).group()) for link in pagination_links]
+def open_page_cache(path, max_size=PAGE_CACHE_MAX_SIZE):
+    global page_cache, page_cache_size, page_cache_max_size
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    # Es una caché: perder las últimas escrituras en un apagón no importa, esperar al disco en cada página sí
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS pages (
+        url TEXT PRIMARY KEY,
+        body BLOB,
+        size INTEGER,
+        etag TEXT,
+        last_modified TEXT,
+        fetched_at REAL,
+        used_at REAL
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS pages_by_use ON pages (used_at)')
+    with page_cache_lock:
+        page_cache = conn
+        page_cache_max_size = max_size
+        page_cache_size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+    page_cache_evict()
+    return conn
+
+def page_cache_get(url):
+    if page_cache is None:
+        return None
+    with page_cache_lock:
+        row = page_cache.execute('SELECT * FROM pages WHERE url = ?', (url,)).fetchone()
+    return dict(row) if row else None
+
+def page_cache_text(entry):
+    return zlib.decompress(entry['body']).decode('utf-8')
+
+def page_cache_store(url, text, etag=None, last_modified=None):
+    global page_cache_size
+    if page_cache is None:
+        return
+    body = zlib.compress(text.encode('utf-8'))
+    now = time.time()
+    with page_cache_lock:
+        old = page_cache.execute('SELECT size FROM pages WHERE url = ?', (url,)).fetchone()
+        page_cache.execute(
+            'INSERT OR REPLACE INTO pages (url, body, size, etag, last_modified, fetched_at, used_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (url, body, len(body), etag, last_modified, now, now),
+        )
+        page_cache_size += len(body) - (old['size'] if old else 0)
+    page_cache_evict()
+
+def page_cache_touch(url, revalidated=False):
+    if page_cache is None:
+        return
+    now = time.time()
+    with page_cache_lock:
+        if revalidated:
+            page_cache.execute('UPDATE pages SET fetched_at = ?, used_at = ? WHERE url = ?', (now, now, url))
+        else:
+            page_cache.execute('UPDATE pages SET used_at = ? WHERE url = ?', (now, url))
+
+def page_cache_evict():
+    # LRU: al pasarse del tamaño máximo se borran las menos usadas hasta bajar al 90%
+    global page_cache_size
+    with page_cache_lock:
+        if page_cache is None or page_cache_size <= page_cache_max_size:
+            return
+        target = page_cache_size - page_cache_max_size * 0.9
+        freed = 0
+        evicted = []
+        for row in page_cache.execute('SELECT url, size FROM pages ORDER BY used_at'):
+            if freed >= target:
+                break
+            evicted.append((row['url'],))
+            freed += row['size']
+        page_cache.executemany('DELETE FROM pages WHERE url = ?', evicted)
+        page_cache_size -= freed
+
+def count_page_cache(key):
+    if page_cache is not None:
+        with page_cache_lock:
+            page_cache_stats[key] += 1
+
+def get_page_cache_stats():
+    with page_cache_lock:
+        return dict(page_cache_stats, bytes=page_cache_size)
+
+def page_cache_lookup(url, route):
+    # Devuelve (texto si sigue fresco, entrada guardada, cabeceras para revalidarla)
+    entry = page_cache_get(url)
+    if entry is None:
+        return None, None, None
+    if time.time() - entry['fetched_at'] <= PAGE_CACHE_TTL.get(route, 0):
+        page_cache_touch(url)
+        count_page_cache('aciertos')
+        return page_cache_text(entry), entry, None
+    headers = {}
+    if entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    return None, entry, headers or None
+
+def page_cache_response(url, entry, response):
+    # Vale para respuestas de requests y de httpx: las dos tienen status_code, headers y text
+    if response.status_code == 304 and entry is not None:
+        page_cache_touch(url, revalidated=True)
+        count_page_cache('revalidadas')
+        return page_cache_text(entry)
+    count_page_cache('fallos')
+    record_metric_bytes(url, len(response.content))
+    text = response.text
+    page_cache_store(url, text, response.headers.get('etag'), response.headers.get('last-modified'))
+    return text
+
+def fetch_page(url, route):
+    # Texto de una página (HTML o JSON) pasando por la caché; None si no se pudo descargar
+    with metric_stage(ROUTE_STAGES.get(route, route), url):
+        text, entry, headers = page_cache_lookup(url, route)
+        if text is not None:
+            return text
+        response = make_request(url, headers=headers)
+        if not response:
+            return None
+        return page_cache_response(url, entry, response)
+
+def get_parser_backend():
+    global parser_backend
+    with parser_lock:
+        if parser_backend is None:
+            available = [name for name in PARSER_PREFERENCE if parser_available(name)]
+            parser_backend = available[0]
+        return parser_backend
+
+def set_parser_backend(name):
+    global parser_backend
+    if name in (None, 'auto'):
+        name = None
+    elif name not in PARSER_PREFERENCE:
+        raise ValueError(f"Parser desconocido: {name} (opciones: {', '.join(PARSER_PREFERENCE)})")
+    elif not parser_available(name):
+        raise ValueError(f"El parser {name} no está instalado")
+    with parser_lock:
+        parser_backend = name
+
+def parser_available(name):
+    if name == 'selectolax':
+        return SelectolaxParser is not None
+    if name == 'lxml':
+        return lxml_html is not None and CSSSelector is not None
+    if name == 'bs4-lxml':
+        return lxml_html is not None
+    return True
+
+def compile_selector(selector, backend=None):
+    # Cada selector se compila una sola vez por ejecución y backend
+    backend = backend or get_parser_backend()
+    key = (backend, selector)
+    compiled = compiled_selectors.get(key)
+    if compiled is None:
+        if backend == 'selectolax':
+            # selectolax no expone selectores precompilados; lexbor los interpreta en C
+            compiled = selector
+        elif backend == 'lxml':
+            compiled = CSSSelector(selector)
+        else:
+            compiled = soupsieve.compile(selector)
+        with parser_lock:
+            compiled_selectors[key] = compiled
+    return compiled
+
+def compile_selectors(config):
+    for key in ('file_link_selector', 'download_link_selector'):
+        if config.get(key):
+            compile_selector(config[key])
+    if config.get('listing_file_rewrite'):
+        if len(config['listing_file_rewrite']) != 2:
+            raise ValueError("listing_file_rewrite tiene que ser [patrón, reemplazo]")
+        pattern, _ = config['listing_file_rewrite']
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f"listing_file_rewrite no es una expresión regular válida: {pattern} ({e})") from e
+
+def parse_document(html, backend):
+    if backend == 'selectolax':
+        return SelectolaxParser(html)
+    if backend == 'lxml':
+        if not html.strip():
+            return None
+        return lxml_html.fromstring(html)
+    return BeautifulSoup(html, 'lxml' if backend == 'bs4-lxml' else 'html.parser')
+
+def select_nodes(document, selector, backend):
+    if document is None:
+        return []
+    compiled = compile_selector(selector, backend)
+    if backend == 'selectolax':
+        return document.css(compiled)
+    if backend == 'lxml':
+        return compiled(document)
+    return compiled.select(document)
+
+def node_attribute(node, attribute, backend):
+    if backend == 'selectolax':
+        return node.attributes.get(attribute)
+    return node.get(attribute)
+
+def node_parent(node, backend):
+    if backend == 'lxml':
+        return node.getparent()
+    return node.parent
+
+def has_attribute(node, attribute, backend):
+    if backend == 'selectolax':
+        return attribute in node.attributes
+    if backend == 'lxml':
+        return attribute in node.attrib
+    return attribute in node.attrs
+
+def parse_total_pages(html, backend=None):
+    backend = backend or get_parser_backend()
+    document = parse_document(html, backend)
+    page_numbers = []
+    for link in select_nodes(document, 'a[href]', backend):
+        href = node_attribute(link, 'href', backend) or ''
+        if re.search(r'\?page=\d+', href):
+            page_numbers.append(int(re.search(r'\d+', href).group()))
+    if page_numbers:
         return max(page_numbers)
     return 1
 
-def get_file_urls(page_url, file_link_selector, file_url_attribute):
-    response = make_request(page_url)
-    if not response:
-        return []
-    soup = BeautifulSoup(response.text, 'html.parser')
-    file_links = soup.select(file_link_selector)
-    return [link[file_url_attribute] for link in file_links if file_url_attribute in link.attrs]
-
-def get_download_url(file_page_url, download_link_selector, base_url):
-    response = make_request(file_page_url)
-    if not response:
-        return None
-    soup = BeautifulSoup(response.text, 'html.parser')
-    download_container = soup.select_one(download_link_selector)
-    if download_container:
-        download_link = download_container.find('a', href=True)
-        if download_link:
-            download_url = download_link['href']
+def parse_file_urls(html, file_link_selector, file_url_attribute, backend=None):
+    backend = backend or get_parser_backend()
+    document = parse_document(html, backend)
+    file_links = select_nodes(document, file_link_selector, backend)
+    return [node_attribute(link, file_url_attribute, backend) for link in file_links if has_attribute(link, file_url_attribute, backend)]
+
+def listing_file_url(link, listing_attribute, rewrite, backend):
+    # Primero el atributo en el enlace o sus contenedores; si no, la regla sobre la miniatura
+    if listing_attribute:
+        node = link
+        for _ in range(LISTING_ANCESTORS + 1):
+            if node is None:
+                break
+            if has_attribute(node, listing_attribute, backend):
+                return node_attribute(node, listing_attribute, backend)
+            node = node_parent(node, backend)
+    if rewrite:
+        pattern, replacement = rewrite
+        for image in select_nodes(link, 'img[src]', backend):
+            src = node_attribute(image, 'src', backend)
+            if re.search(pattern, src):
+                return re.sub(pattern, replacement, src, count=1)
+    return None
+
+def parse_listing(html, file_link_selector, file_url_attribute, listing_attribute=None, rewrite=None, backend=None):
+    # Como parse_file_urls, pero con la URL del archivo de cada post si el listado la trae (o None)
+    backend = backend or get_parser_backend()
+    document = parse_document(html, backend)
+    file_links = select_nodes(document, file_link_selector, backend)
+    return [
+        (node_attribute(link, file_url_attribute, backend), listing_file_url(link, listing_attribute, rewrite, backend))
+        for link in file_links if has_attribute(link, file_url_attribute, backend)
+    ]
+
+def parse_download_url(html, download_link_selector, base_url, backend=None):
+    backend = backend or get_parser_backend()
+    document = parse_document(html, backend)
+    containers = select_nodes(document, download_link_selector, backend)
+    if containers:
+        # Como el find('a', href=True) de antes: el primer enlace con href dentro del contenedor
+        download_links = select_nodes(containers[0], 'a[href]', backend)
+        if backend in ('selectolax', 'lxml'):
+            # Estos backends incluyen al propio contenedor en la selección
+            download_links = [link for link in download_links if link != containers[0]]
+        if download_links:
+            download_url = node_attribute(download_links[0], 'href', backend)
             if download_url.startswith('/'):
                 download_url = base_url + download_url
             return download_url
     return None
 
-def get_file_size(url):
-    response = make_request(url, retries=1)
-    if response and 'content-length' in response.headers:
-        return int(response.headers['content-length'])
-    return 0
+def init_parse_worker():
+    # El Ctrl+C lo gestiona el proceso principal, que cancela lo que quede en la cola
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def start_parse_pool(processes):
+    global parse_pool
+    stop_parse_pool()
+    if processes == 'auto':
+        processes = os.cpu_count() or 1
+    if not processes:
+        return None
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        # Sin fork los procesos hijos no pueden cargar este script (tiene espacios en el nombre)
+        print("Este sistema no permite fork: el HTML se analizará en los hilos de descarga.")
+        return None
+    parse_pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'), initializer=init_parse_worker)
+    # Con fork se crean todos los procesos en el primer envío; mejor ahora, antes de arrancar hilos
+    parse_pool.submit(get_parser_backend).result()
+    return parse_pool
+
+def stop_parse_pool():
+    global parse_pool
+    if parse_pool is not None:
+        parse_pool.shutdown(wait=False, cancel_futures=True)
+        parse_pool = None
+
+def parse_html(function, *args):
+    # Cada página vuelve entera y con sus URLs en orden; el hilo espera sin tener el GIL
+    backend = get_parser_backend()
+    with metric_stage('analisis', function.__name__):
+        if parse_pool is None:
+            return function(*args, backend)
+        return parse_pool.submit(function, *args, backend).result()
+
+async def async_parse_html(function, *args):
+    backend = get_parser_backend()
+    with metric_stage('analisis', function.__name__):
+        if parse_pool is None:
+            return function(*args, backend)
+        return await asyncio.get_running_loop().run_in_executor(parse_pool, functools.partial(function, *args, backend))
+
+def get_total_pages(config):
+    # None si el sitio no dice cuántas páginas hay: entonces se lee hasta la primera vacía
+    resolver = get_resolver(config)
+    pages_url = resolver.pages_url(config)
+    if pages_url is None:
+        return None
+    text = fetch_page(pages_url, 'count')
+    if text is None:
+        return None
+    return parse_html(resolver.parse_pages, config, text)
+
+def fetch_post_download_url(post_url, config):
+    resolver = get_resolver(config)
+    text = fetch_page(resolver.post_url(config, post_url), 'post')
+    if text is None:
+        return None
+    return parse_html(resolver.parse_post, config, text)
+
+class Resolver(ABC):
+    # De dónde salen los posts de una búsqueda y la URL del archivo de cada uno. Las peticiones
+    # las hace el motor (hilos o async); el resolver solo dice qué pedir y cómo leer la respuesta,
+    # así que sus parse_* tienen que poder ir a la pool de procesos. Un resolver al que le falte
+    # un método abstracto falla al crearlo en RESOLVERS, no a mitad de una descarga
+    required_keys = ('base_url', 'search_url')
+
+    @abstractmethod
+    def page_url(self, config, page):
+        raise NotImplementedError
+
+    @abstractmethod
+    def parse_page(self, config, text, backend=None):
+        # Lista de posts: {'post_url'} y, si el listado ya lo trae, 'download_url', 'md5' y 'size'
+        raise NotImplementedError
+
+    def pages_url(self, config):
+        # Qué pedir para saber cuántas páginas hay; None si el sitio no lo dice
+        return None
+
+    def parse_pages(self, config, text, backend=None):
+        return None
+
+    def post_url(self, config, post_url):
+        # Qué pedir para resolver un post que no vino resuelto en el listado
+        return post_url
+
+    @abstractmethod
+    def parse_post(self, config, text, backend=None):
+        raise NotImplementedError
+
+class HtmlResolver(Resolver):
+    # El de siempre, sin API: listados HTML con selectores CSS y una visita a la página de cada post
+    required_keys = ('base_url', 'search_url', 'file_link_selector', 'file_url_attribute', 'download_link_selector')
+
+    def page_url(self, config, page):
+        return config['search_url'].replace('{{page}}', str(page))
+
+    def parse_page(self, config, text, backend=None):
+        # Con listing_file_attribute o listing_file_rewrite la URL del archivo sale del propio listado;
+        # los posts en los que no esté se resuelven visitando su página, como siempre
+        if not (config.get('listing_file_attribute') or config.get('listing_file_rewrite')):
+            file_urls = parse_file_urls(text, config['file_link_selector'], config['file_url_attribute'], backend)
+            return [{'post_url': normalize_post_url(file_url, config['base_url'])} for file_url in file_urls]
+        listing = parse_listing(
+            text, config['file_link_selector'], config['file_url_attribute'],
+            config.get('listing_file_attribute'), config.get('listing_file_rewrite'), backend,
+        )
+        return [
+            {
+                'post_url': normalize_post_url(file_url, config['base_url']),
+                'download_url': absolute_url(download_url, config['base_url']) if download_url else None,
+            }
+            for file_url, download_url in listing
+        ]
+
+    def pages_url(self, config):
+        return self.page_url(config, 1)
+
+    def parse_pages(self, config, text, backend=None):
+        return parse_total_pages(text, backend)
+
+    def parse_post(self, config, text, backend=None):
+        return parse_download_url(text, config['download_link_selector'], config['base_url'], backend)
+
+class JsonResolver(Resolver):
+    # APIs JSON de los boorus: un listado trae cientos de posts con la URL del archivo, el MD5 y
+    # el tamaño. Las etiquetas salen del parámetro tags de search_url; api_url, api_limit y
+    # api_params (login, api_key...) del perfil cambian la dirección, los posts por página y la auth
+    limit = 100
+
+    def api_url(self, config, path, **params):
+        query = dict(config.get('api_params', {}), **params)
+        return (config.get('api_url') or config['base_url']).rstrip('/') + path + '?' + urlencode(query)
+
+    def api_limit(self, config):
+        return int(config.get('api_limit', self.limit))
+
+    def tags(self, config):
+        return parse_qs(urlparse(config['search_url']).query).get('tags', [''])[0]
+
+    def load(self, text):
+        # Algunos sitios contestan con el cuerpo vacío cuando no hay resultados
+        return json.loads(text) if text.strip() else []
+
+    def posts(self, data):
+        return data
+
+    @abstractmethod
+    def link(self, config, post_id):
+        raise NotImplementedError
+
+    def entry(self, config, post):
+        download_url = post.get('file_url')
+        return {
+            'post_url': self.link(config, post['id']),
+            'download_url': absolute_url(download_url, config['base_url']) if download_url else None,
+            'md5': post.get('md5'),
+            'size': post.get('file_size'),
+        }
+
+    def parse_page(self, config, text, backend=None):
+        return [self.entry(config, post) for post in self.posts(self.load(text)) if post.get('id') is not None]
+
+    def parse_post(self, config, text, backend=None):
+        posts = self.posts(self.load(text))
+        if isinstance(posts, dict):
+            posts = [posts]
+        return self.entry(config, posts[0])['download_url'] if posts else None
+
+class DanbooruResolver(JsonResolver):
+    limit = 200
+
+    def page_url(self, config, page):
+        return self.api_url(config, '/posts.json', tags=self.tags(config), page=page, limit=self.api_limit(config))
+
+    def pages_url(self, config):
+        return self.api_url(config, '/counts/posts.json', tags=self.tags(config))
+
+    def parse_pages(self, config, text, backend=None):
+        # Con búsquedas muy pesadas Danbooru devuelve el recuento vacío
+        count = self.load(text).get('counts', {}).get('posts')
+        return None if count is None else math.ceil(count / self.api_limit(config))
+
+    def link(self, config, post_id):
+        return f"{config['base_url']}/posts/{post_id}"
+
+    def post_url(self, config, post_url):
+        return self.api_url(config, f'/posts/{extract_post_id(post_url)}.json')
+
+class MoebooruResolver(JsonResolver):
+    # yande.re, konachan...: el JSON no dice cuántos posts hay
+    def page_url(self, config, page):
+        return self.api_url(config, '/post.json', tags=self.tags(config), page=page, limit=self.api_limit(config))
+
+    def link(self, config, post_id):
+        return f"{config['base_url']}/post/show/{post_id}"
+
+    def post_url(self, config, post_url):
+        return self.api_url(config, '/post.json', tags=f'id:{extract_post_id(post_url)}')
+
+class GelbooruResolver(JsonResolver):
+    # Gelbooru 0.2 (gelbooru, safebooru, rule34...): páginas desde 0 en pid; los más nuevos envuelven
+    # los posts con @attributes, donde viene el total, y los antiguos devuelven la lista a secas
+    def page_url(self, config, page, limit=None):
+        return self.api_url(
+            config, '/index.php', page='dapi', s='post', q='index', json=1,
+            tags=self.tags(config), pid=page - 1, limit=limit or self.api_limit(config),
+        )
+
+    def pages_url(self, config):
+        return self.page_url(config, 1, limit=1)
+
+    def parse_pages(self, config, text, backend=None):
+        data = self.load(text)
+        if not isinstance(data, dict) or 'count' not in data.get('@attributes', {}):
+            return None
+        return math.ceil(int(data['@attributes']['count']) / self.api_limit(config))
+
+    def posts(self, data):
+        return data.get('post', []) if isinstance(data, dict) else data
+
+    def link(self, config, post_id):
+        return f"{config['base_url']}/index.php?page=post&s=view&id={post_id}"
+
+    def post_url(self, config, post_url):
+        return self.api_url(config, '/index.php', page='dapi', s='post', q='index', json=1, id=extract_post_id(post_url))
+
+RESOLVERS = {
+    'html': HtmlResolver(),
+    'danbooru': DanbooruResolver(),
+    'moebooru': MoebooruResolver(),
+    'gelbooru': GelbooruResolver(),
+}
+
+def get_resolver(config):
+    name = config.get('resolver', 'html')
+    if name not in RESOLVERS:
+        raise ValueError(f"Resolver desconocido: {name} (opciones: {', '.join(RESOLVERS)})")
+    return RESOLVERS[name]
+
+def count_connection(key):
+    with connection_stats_lock:
+        connection_stats[key] += 1
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        count_connection('nuevas')
+        return super()._new_conn()
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        count_connection('nuevas')
+        return super()._new_conn()
+
+class CountingHTTPAdapter(HTTPAdapter):
+    # Adaptador que cuenta peticiones y conexiones abiertas para saber cuántas se reutilizan
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        count_connection('peticiones')
+        return super().send(request, **kwargs)
+
+def get_session():
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            session = requests.Session()
+            adapter = CountingHTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update(DEFAULT_HEADERS)
+            http_session = session
+        return http_session
+
+def configure_session(headers=None, cookies=None):
+    # Cabeceras y cookies por defecto para todas las peticiones (p. ej. búsquedas con sesión iniciada)
+    session = get_session()
+    if headers:
+        session.headers.update(headers)
+    if cookies:
+        session.cookies.update(cookies)
+
+def get_connection_stats():
+    with connection_stats_lock:
+        requests_sent = connection_stats['peticiones']
+        new_connections = connection_stats['nuevas']
+    return {
+        'peticiones': requests_sent,
+        'nuevas': new_connections,
+        'reutilizadas': max(requests_sent - new_connections, 0),
+    }
+
+def get_host(url):
+    return urlparse(url).netloc
+
+def get_host_semaphore(host):
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            limit = HOST_CONNECTIONS.get(host, DEFAULT_HOST_CONNECTIONS)
+            host_semaphores[host] = threading.BoundedSemaphore(limit)
+        return host_semaphores[host]
+
+@contextmanager
+def host_slot(url):
+    # Limita las conexiones abiertas a la vez contra un mismo host. Como en async_slot, el turno del
+    # limitador se espera antes de coger el hueco: un host frenado no deja los huecos ocupados durmiendo
+    semaphore = get_host_semaphore(get_host(url))
+    clock = profile_clock()
+    delay = get_rate_limiter(url).reserve()
+    if delay > 0:
+        stop_event.wait(delay)
+    with semaphore:
+        if clock:
+            profile_add('espera', clock)
+        yield
+
+class TokenBucket:
+    # Cubo de tokens con capacidad para un segundo de ritmo; sirve para peticiones y para bytes
+    def __init__(self, rate, tokens=None):
+        self.rate = rate
+        self.tokens = rate if tokens is None else tokens
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, cost, now):
+        # Se llama con el lock cogido; devuelve cuántos segundos hay que esperar para usar lo reservado
+        self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= cost
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def reserve(self, cost=1.0):
+        with self.lock:
+            return self.take(cost, time.monotonic())
+
+class HostRateLimiter(TokenBucket):
+    # Limitador de peticiones de un host; el ritmo lo ajusta record()
+    def __init__(self, host, rate):
+        super().__init__(rate, tokens=1.0)
+        self.host = host
+        self.blocked_until = 0.0
+        self.last_cut = 0.0
+        self.latency = None
+        self.best_latency = None
+        self.throttled = 0
+
+    def reserve(self, cost=1.0):
+        with self.lock:
+            now = time.monotonic()
+            return max(self.take(cost, now), self.blocked_until - now)
+
+    def record(self, status, elapsed, retry_after=None):
+        # status None = timeout o conexión rechazada
+        with self.lock:
+            now = time.monotonic()
+            if status in THROTTLE_STATUS or status is None:
+                if status is not None:
+                    self.throttled += 1
+                if retry_after:
+                    # Con el mismo tope que retry_delay: un Retry-After de un día no para el host un día
+                    self.blocked_until = max(self.blocked_until, now + min(retry_after, RETRY_MAX_DELAY))
+                self.cut(now, f"respuesta {status}" if status else "timeout")
+                return
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+            self.best_latency = self.latency if self.best_latency is None else min(self.best_latency, self.latency)
+            # El margen fijo evita que unas décimas de más en un servidor muy rápido cuenten como saturación
+            if self.latency > max(self.best_latency * LATENCY_THRESHOLD, self.best_latency + 0.25):
+                self.cut(now, f"latencia de {self.latency:.2f} s")
+            else:
+                # Sumar RATE_INCREASE / rate por respuesta es sumar ~RATE_INCREASE pet/s cada segundo
+                self.rate = min(MAX_RATE, self.rate + RATE_INCREASE / self.rate)
+
+    def cut(self, now, reason):
+        # Las peticiones que ya estaban en vuelo también fallan: un solo recorte por segundo
+        if now - self.last_cut < 1.0:
+            return
+        self.last_cut = now
+        self.rate = max(MIN_RATE, self.rate * RATE_DECREASE)
+        self.tokens = min(self.tokens, 0.0)
+        tqdm.write(f"{self.host}: {reason}, bajamos a {self.rate:.1f} peticiones/s")
+
+def get_rate_limiter(url):
+    host = get_host(url)
+    with rate_limiters_lock:
+        if host not in rate_limiters:
+            rate_limiters[host] = HostRateLimiter(host, HOST_RATES.get(host, INITIAL_RATE))
+        return rate_limiters[host]
+
+def get_bandwidth_bucket(key):
+    with rate_limiters_lock:
+        if key not in bandwidth_buckets:
+            limit = BANDWIDTH_LIMITS.get(key)
+            bandwidth_buckets[key] = TokenBucket(limit) if limit else None
+        return bandwidth_buckets[key]
+
+def bandwidth_delay(url, size):
+    # Cuánto hay que esperar tras recibir size bytes para no pasar del ancho de banda total ni del host
+    delay = 0.0
+    for key in ('*', get_host(url)):
+        bucket = get_bandwidth_bucket(key)
+        if bucket is not None:
+            delay = max(delay, bucket.reserve(size))
+    return delay
+
+def get_rate_stats():
+    with rate_limiters_lock:
+        limiters = list(rate_limiters.values())
+    return {limiter.host: {'ritmo': limiter.rate, 'limitado': limiter.throttled} for limiter in limiters}
+
+def parse_retry_after(value):
+    # Retry-After puede venir en segundos o como fecha HTTP
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+def record_response(url, response, started):
+    retry_after = None
+    status = None
+    if response is not None:
+        status = response.status_code
+        retry_after = parse_retry_after(response.headers.get('retry-after'))
+    elapsed = time.monotonic() - started
+    get_rate_limiter(url).record(status, elapsed, retry_after)
+    record_metric_response(url, status, elapsed)
+    if profiling and 'traza' in profiling:
+        profile_event(f'{status or "error"} {get_host(url)}', 'http', started, elapsed, {'url': url})
+
+def observe(histogram, key, value):
+    # Histograma acumulado al estilo Prometheus: [cuentas por cubeta, suma, total]
+    entry = histogram.get(key)
+    if entry is None:
+        entry = histogram[key] = [[0] * len(METRICS_BUCKETS), 0.0, 0]
+    for i, bound in enumerate(METRICS_BUCKETS):
+        if value <= bound:
+            entry[0][i] += 1
+    entry[1] += value
+    entry[2] += 1
+
+@contextmanager
+def metric_stage(stage, detail=None):
+    # Las peticiones hechas dentro se apuntan a esta etapa; vale para hilos y para tareas de asyncio
+    token = current_stage.set(stage)
+    started = time.monotonic()
+    frame = profile_enter() if profiling else None
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+        elapsed = time.monotonic() - started
+        with metrics_lock:
+            observe(metrics['duracion'], stage, elapsed)
+        if frame is not None:
+            profile_exit(frame, stage, started, elapsed, detail)
+
+def record_metric_response(url, status, elapsed):
+    stage = current_stage.get()
+    key = (stage, get_host(url), str(status or 'error'))
+    with metrics_lock:
+        metrics['respuestas'][key] = metrics['respuestas'].get(key, 0) + 1
+        observe(metrics['latencia'], stage, elapsed)
+
+def record_metric_bytes(url, size):
+    key = (current_stage.get(), get_host(url))
+    with metrics_lock:
+        metrics['bytes'][key] = metrics['bytes'].get(key, 0) + size
+
+def record_metric_retry():
+    stage = current_stage.get()
+    with metrics_lock:
+        metrics['reintentos'][stage] = metrics['reintentos'].get(stage, 0) + 1
+
+def record_metric_post(key):
+    with metrics_lock:
+        metrics['posts'][key] = metrics['posts'].get(key, 0) + 1
+
+def watch_queues(**queues):
+    # Colas del pipeline (de hilos o de asyncio) cuya ocupación se apunta en cada instantánea
+    with metrics_lock:
+        metrics_queues.clear()
+        metrics_queues.update(queues)
+
+def histogram_snapshot(entry):
+    counts, total, count = entry
+    return {'cubetas': dict(zip(map(str, METRICS_BUCKETS), counts)), 'suma': round(total, 6), 'cuenta': count}
+
+def get_metrics():
+    with metrics_lock:
+        queues = {
+            name: sum(q.qsize() for q in (value if isinstance(value, list) else [value]))
+            for name, value in metrics_queues.items()
+        }
+        stages = {}
+        for (stage, host, status), count in metrics['respuestas'].items():
+            stage_entry = stages.setdefault(stage, {})
+            stage_entry.setdefault('respuestas', {}).setdefault(host, {})[status] = count
+        for (stage, host), size in metrics['bytes'].items():
+            stages.setdefault(stage, {}).setdefault('bytes', {})[host] = size
+        for stage, count in metrics['reintentos'].items():
+            stages.setdefault(stage, {})['reintentos'] = count
+        for name in ('latencia', 'duracion'):
+            for stage, entry in metrics[name].items():
+                stages.setdefault(stage, {})[name] = histogram_snapshot(entry)
+        posts = dict(metrics['posts'])
+    elapsed = time.time() - metrics_started
+    return {
+        'timestamp': time.time(),
+        'segundos': round(elapsed, 3),
+        'etapas': stages,
+        'colas': queues,
+        'posts': posts,
+        'archivos_por_segundo': round(posts.get('descargados', 0) / elapsed, 3) if elapsed > 0 else 0.0,
+    }
+
+def prometheus_labels(**labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def format_prometheus(snapshot):
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            lines.append(f'{name}{labels} {value}')
+
+    def histogram(name, help_text, key):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for stage, data in stages.items():
+            if key not in data:
+                continue
+            # Las cubetas ya son acumuladas, como las quiere Prometheus
+            for bound, count in data[key]['cubetas'].items():
+                lines.append(f'{name}_bucket{prometheus_labels(stage=stage, le=bound)} {count}')
+            lines.append(f'{name}_bucket{prometheus_labels(stage=stage, le="+Inf")} {data[key]["cuenta"]}')
+            lines.append(f'{name}_sum{prometheus_labels(stage=stage)} {data[key]["suma"]}')
+            lines.append(f'{name}_count{prometheus_labels(stage=stage)} {data[key]["cuenta"]}')
+
+    stages = snapshot['etapas']
+    metric('bdt_responses_total', 'counter', 'Respuestas HTTP por etapa, host y código', [
+        (prometheus_labels(stage=stage, host=host, status=status), count)
+        for stage, data in stages.items()
+        for host, statuses in data.get('respuestas', {}).items()
+        for status, count in statuses.items()
+    ])
+    metric('bdt_bytes_total', 'counter', 'Bytes recibidos por etapa y host', [
+        (prometheus_labels(stage=stage, host=host), size)
+        for stage, data in stages.items()
+        for host, size in data.get('bytes', {}).items()
+    ])
+    metric('bdt_retries_total', 'counter', 'Reintentos por etapa', [
+        (prometheus_labels(stage=stage), data['reintentos'])
+        for stage, data in stages.items() if 'reintentos' in data
+    ])
+    histogram('bdt_request_seconds', 'Hasta las cabeceras de cada respuesta, por etapa', 'latencia')
+    histogram('bdt_stage_seconds', 'Duración de cada operación de la etapa, reintentos incluidos', 'duracion')
+    metric('bdt_posts_total', 'counter', 'Posts por resultado', [
+        (prometheus_labels(result=key), count) for key, count in snapshot['posts'].items()
+    ])
+    metric('bdt_queue_depth', 'gauge', 'Elementos esperando en cada cola del pipeline', [
+        (prometheus_labels(queue=name), size) for name, size in snapshot['colas'].items()
+    ])
+    metric('bdt_files_per_second', 'gauge', 'Archivos descargados por segundo desde el inicio', [
+        ('', snapshot['archivos_por_segundo'])
+    ])
+    return '\n'.join(lines) + '\n'
+
+def write_metrics(path=None):
+    path = path or metrics_path
+    if not path:
+        return
+    snapshot = get_metrics()
+    if path.endswith('.prom'):
+        content = format_prometheus(snapshot)
+    else:
+        content = json.dumps(snapshot, ensure_ascii=False, indent=1)
+    # Se escribe aparte y se renombra: quien lo lea nunca ve un archivo a medias
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+def start_metrics(path, interval=METRICS_INTERVAL):
+    global metrics_path, metrics_thread, metrics_started
+    metrics_started = time.time()
+    metrics_path = path
+    if not path or metrics_thread is not None:
+        return
+    metrics_stop.clear()
+
+    def writer():
+        while not metrics_stop.wait(interval):
+            try:
+                write_metrics()
+            except OSError as e:
+                tqdm.write(f"No se pudieron escribir las métricas en {path}: {e}")
+
+    metrics_thread = threading.Thread(target=writer, name='metrics', daemon=True)
+    metrics_thread.start()
+
+def stop_metrics():
+    # La última instantánea se escribe siempre, también al interrumpir
+    global metrics_thread
+    metrics_stop.set()
+    if metrics_thread is not None:
+        metrics_thread.join()
+        metrics_thread = None
+    if metrics_path:
+        write_metrics()
+
+def current_task():
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        return None
+
+def thread_cpu():
+    # En el motor async todas las tareas comparten hilo: el CPU de una etapa no se puede separar
+    return None if current_task() is not None else time.thread_time()
+
+def profile_owner():
+    return threading.get_ident(), id(current_task())
+
+def profile_enter():
+    # Marco de la etapa en curso: sus hijas le van sumando lo suyo para que su tiempo sea exclusivo
+    frame = {'cpu': thread_cpu(), 'child_wall': 0.0, 'child_cpu': 0.0, 'owner': profile_owner()}
+    frame['token'] = current_frame.set(frame)
+    return frame
+
+def profile_exit(frame, stage, started, elapsed, detail=None):
+    current_frame.reset(frame['token'])
+    cpu = None if frame['cpu'] is None else time.thread_time() - frame['cpu']
+    profile_account(stage, elapsed, cpu, elapsed - frame['child_wall'], None if cpu is None else cpu - frame['child_cpu'])
+    if 'traza' in profiling:
+        profile_event(stage, 'etapa', started, elapsed, {'detalle': detail} if detail else None)
+
+def profile_clock():
+    # Para medidas muy frecuentes (cada trozo escrito): None y nada más si no se está perfilando
+    if not profiling:
+        return None
+    return time.monotonic(), thread_cpu()
+
+def profile_add(stage, clock):
+    elapsed = time.monotonic() - clock[0]
+    cpu = None if clock[1] is None else time.thread_time() - clock[1]
+    profile_account(stage, elapsed, cpu, elapsed, cpu)
+
+def profile_account(stage, elapsed, cpu, own_wall, own_cpu):
+    parent = current_frame.get()
+    # Los segmentos heredan el contexto de su descarga pero van en otros hilos: no se le restan
+    if parent is not None and parent['owner'] == profile_owner():
+        parent['child_wall'] += elapsed
+        parent['child_cpu'] += cpu or 0.0
+    with profile_lock:
+        totals = profile_totals.setdefault(stage, {'llamadas': 0, 'real': 0.0, 'cpu': 0.0, 'sin_cpu': 0})
+        totals['llamadas'] += 1
+        totals['real'] += own_wall
+        if own_cpu is None:
+            totals['sin_cpu'] += 1
+        else:
+            totals['cpu'] += max(own_cpu, 0.0)
+
+def profile_lane():
+    # Cada hilo, o cada tarea en el motor async, es una fila de la línea de tiempo
+    task = current_task()
+    key = id(task) if task is not None else threading.get_ident()
+    lane = profile_lanes.get(key)
+    if lane is None:
+        name = task.get_name() if task is not None else threading.current_thread().name
+        with profile_lock:
+            lane = profile_lanes.setdefault(key, (len(profile_lanes) + 1, name))
+    return lane[0]
+
+def profile_event(name, category, started, elapsed, args=None):
+    event = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': round((started - profile_started) * 1e6),
+        'dur': round(elapsed * 1e6),
+        'pid': 1,
+        'tid': profile_lane(),
+    }
+    if args:
+        event['args'] = args
+    with profile_lock:
+        if len(profile_events) < PROFILE_MAX_EVENTS:
+            profile_events.append(event)
+
+def sample_stacks(interval):
+    # Muestreo de reloj, no de CPU: un hilo parado en recv o en una cola también sale, y eso es
+    # justo lo que dice si esperamos a la red. Los procesos de análisis no se ven desde aquí
+    own = threading.get_ident()
+    while not profile_sampler_stop.wait(interval):
+        names = {thread.ident: re.sub(r'-\d+$', '', thread.name) for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            key = ';'.join(reversed(stack))
+            profile_samples[key] = profile_samples.get(key, 0) + 1
+
+def parse_profile_modes(modes):
+    # True, 'etapas', 'traza,muestras' o una lista; 'etapas' va siempre
+    if modes is True:
+        modes = ()
+    elif isinstance(modes, str):
+        modes = [mode.strip() for mode in modes.split(',') if mode.strip()]
+    unknown = [mode for mode in modes if mode not in PROFILE_MODES]
+    if unknown:
+        raise ValueError(f"Modo de perfilado desconocido: {', '.join(unknown)} (hay: {', '.join(PROFILE_MODES)})")
+    return {'etapas', *modes}
+
+def start_profiling(modes, folder):
+    global profiling, profile_folder, profile_started, profile_cpu_started, profile_sampler
+    if not modes:
+        return
+    modes = parse_profile_modes(modes)
+    profile_folder = folder
+    profile_started = time.monotonic()
+    profile_cpu_started = time.process_time()
+    profile_totals.clear()
+    profile_events.clear()
+    profile_samples.clear()
+    profile_lanes.clear()
+    profiling = modes
+    if 'muestras' in profiling:
+        profile_sampler_stop.clear()
+        profile_sampler = threading.Thread(target=sample_stacks, args=(PROFILE_SAMPLE_INTERVAL,), name='profiler', daemon=True)
+        profile_sampler.start()
+
+def print_profile(wall, cpu):
+    with profile_lock:
+        totals = sorted(profile_totals.items(), key=lambda item: item[1]['real'], reverse=True)
+    stage_time = sum(data['real'] for _, data in totals) or 1.0
+    print(f"\nPerfilado: {wall:.1f} s de reloj, {cpu:.1f} s de CPU del proceso ({cpu / wall:.0%} de un núcleo)")
+    print(f"{'etapa':<11}{'llamadas':>9}{'real (s)':>11}{'%':>6}{'CPU (s)':>10}{'CPU/real':>10}")
+    for stage, data in totals:
+        measured = data['llamadas'] - data['sin_cpu']
+        cpu_text = f"{data['cpu']:10.2f}{data['cpu'] / data['real']:>10.0%}" if measured and data['real'] else f"{'-':>10}{'-':>10}"
+        print(f"{stage:<11}{data['llamadas']:>9}{data['real']:>11.2f}{data['real'] / stage_time:>6.0%}{cpu_text}")
+    if totals:
+        # Los tiempos se suman entre hilos: lo que importa es el reparto, no el total
+        stage, data = totals[0]
+        print(f"La mayor parte del tiempo de los hilos se va esperando a {PROFILE_BOUND.get(stage, 'la red')} ({stage}).")
+    if any(data['sin_cpu'] for _, data in totals):
+        print("Con el motor async las tareas comparten hilo y el CPU por etapa no se puede separar (sale '-').")
+
+def stop_profiling():
+    # Resumen en pantalla y, según el modo, la traza y las muestras en .bdt/perfil/
+    global profiling, profile_sampler
+    if not profiling:
+        return None
+    modes = profiling
+    profiling = None
+    if profile_sampler is not None:
+        profile_sampler_stop.set()
+        profile_sampler.join()
+        profile_sampler = None
+    print_profile(time.monotonic() - profile_started, time.process_time() - profile_cpu_started)
+    os.makedirs(profile_folder, exist_ok=True)
+    prefix = os.path.join(profile_folder, time.strftime('%Y%m%d-%H%M%S'))
+    written = []
+    with open(prefix + '.etapas.json', 'w', encoding='utf-8') as f:
+        json.dump(profile_totals, f, ensure_ascii=False, indent=1)
+    written.append(prefix + '.etapas.json')
+    if 'traza' in modes:
+        lanes = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}}
+            for tid, name in profile_lanes.values()
+        ]
+        with open(prefix + '.trace.json', 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': lanes + profile_events, 'displayTimeUnit': 'ms'}, f)
+        written.append(prefix + '.trace.json')
+        if len(profile_events) >= PROFILE_MAX_EVENTS:
+            print(f"La traza se cortó en {PROFILE_MAX_EVENTS} eventos.")
+    if 'muestras' in modes:
+        with open(prefix + '.muestras.txt', 'w', encoding='utf-8') as f:
+            for stack, count in sorted(profile_samples.items()):
+                f.write(f'{stack} {count}\n')
+        written.append(prefix + '.muestras.txt')
+    print("Perfil guardado en: " + ', '.join(written))
+    return written
+
+def finish_run():
+    # Lo último de cada ejecución, también al interrumpirla: procesos de análisis, métricas finales y perfil
+    stop_parse_pool()
+    stop_metrics()
+    stop_profiling()
+
+def limited_request(method, url, **kwargs):
+    # Todas las peticiones le cuentan al limitador de su host cómo les ha ido; el turno ya lo
+    # ha esperado host_slot, que envuelve siempre a esta función
+    started = time.monotonic()
+    try:
+        response = get_session().request(method, url, timeout=30, **kwargs)
+    except (requests.Timeout, requests.ConnectionError):
+        record_response(url, None, started)
+        raise
+    record_response(url, response, started)
+    return response
+
+def is_retryable(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return True
+    return response.status_code >= 500 or response.status_code in RETRY_STATUS
+
+def retry_delay(attempt, error=None):
+    # Si el servidor dice cuánto esperar le hacemos caso; si no, espera exponencial con jitter
+    # para que los hilos que fallaron a la vez no vuelvan a la vez
+    response = getattr(error, 'response', None)
+    if response is not None:
+        retry_after = parse_retry_after(response.headers.get('retry-after'))
+        if retry_after is not None:
+            return min(retry_after, RETRY_MAX_DELAY)
+    delay = min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def update_progress(progress_bar, size):
+    with progress_lock:
+        progress_bar.update(size)
+
+def probe_info(response, size):
+    return {
+        'size': size,
+        'etag': response.headers.get('etag'),
+        'last_modified': response.headers.get('last-modified'),
+    }
+
+def probe_head(url):
+    with host_slot(url):
+        response = limited_request('head', url, allow_redirects=True)
+    response.raise_for_status()
+    if 'content-length' in response.headers:
+        return probe_info(response, int(response.headers['content-length']))
+    return None
+
+def probe_range(url):
+    # Pedimos un solo byte y leemos el tamaño total de Content-Range
+    with host_slot(url), limited_request('get', url, headers={'Range': 'bytes=0-0'}, stream=True) as response:
+        response.raise_for_status()
+        if response.status_code == 206:
+            match = re.search(r'/(\d+)\s*$', response.headers.get('content-range', ''))
+            if match:
+                return probe_info(response, int(match.group(1)))
+            return None
+        # El servidor ignoró el Range; nos vale la cabecera si la manda, sin leer el cuerpo
+        if 'content-length' in response.headers:
+            return probe_info(response, int(response.headers['content-length']))
+    return None
+
+def probe_stream(url):
+    # Último recurso: descargar y tirar los bytes, contándolos
+    with host_slot(url), limited_request('get', url, stream=True) as response:
+        response.raise_for_status()
+        if 'content-length' in response.headers:
+            return probe_info(response, int(response.headers['content-length']))
+        size = 0
+        for chunk in response.iter_content(chunk_size=65536):
+            size += len(chunk)
+        return probe_info(response, size)
+
+SIZE_PROBES = {
+    'head': probe_head,
+    'range': probe_range,
+    'stream': probe_stream,
+}
+
+def probe_file(url):
+    host = get_host(url)
+    with host_probe_lock:
+        known_method = host_probe_methods.get(host)
+    if known_method:
+        methods = (known_method,) + tuple(m for m in SIZE_PROBE_METHODS if m != known_method)
+    else:
+        methods = SIZE_PROBE_METHODS
+
+    for method in methods:
+        try:
+            with metric_stage('sondeo', url):
+                info = SIZE_PROBES[method](url)
+        except requests.RequestException:
+            info = None
+        if info is not None:
+            with host_probe_lock:
+                host_probe_methods[host] = method
+            return info
+    print(f"No se pudo averiguar el tamaño de {url}")
+    return None
+
+def normalize_post_url(file_url, base_url):
+    if not file_url.startswith(('http://', 'https://')):
+        file_url = base_url + file_url
+    return file_url
+
+def absolute_url(url, base_url):
+    # Las URLs de archivo pueden venir relativas a la raíz (/data/...) o al protocolo (//cdn...)
+    if url.startswith('//'):
+        return urlparse(base_url).scheme + ':' + url
+    return normalize_post_url(url, base_url)
+
+def load_resolve_cache(path, ttl=RESOLVE_CACHE_TTL):
+    if not os.path.exists(path):
+        return 0
+    now = time.time()
+    loaded = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if now - entry.get('timestamp', 0) <= ttl:
+                loaded[entry['post_url']] = entry
+    with resolve_cache_lock:
+        resolve_cache.update(loaded)
+    # Reescribimos el archivo sin las entradas caducadas ni duplicadas
+    with open(path, 'w', encoding='utf-8') as f:
+        for entry in loaded.values():
+            f.write(json.dumps(entry) + '\n')
+    return len(loaded)
+
+def store_resolve_entry(entry, path=None):
+    with resolve_cache_lock:
+        resolve_cache[entry['post_url']] = entry
+        if path:
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+
+def new_resolve_entry(post_url, download_url):
+    return {
+        'post_url': post_url,
+        'download_url': download_url,
+        'size': None,
+        'etag': None,
+        'last_modified': None,
+        'timestamp': time.time(),
+    }
+
+def lookup_resolved(post_url):
+    # Primero la caché de resolución y después el diario, que no caduca
+    with resolve_cache_lock:
+        entry = resolve_cache.get(post_url)
+    if entry is None:
+        record = journal_get(post_url)
+        if record and record['download_url']:
+            entry = new_resolve_entry(post_url, record['download_url'])
+    return entry
+
+def remember_resolved(post_url, download_url, config, store=True):
+    if not download_url:
+        journal_mark(post_url, 'failed', error='sin enlace de descarga')
+        return None
+    journal_mark(post_url, 'resolved', download_url=download_url)
+    entry = new_resolve_entry(post_url, download_url)
+    if store:
+        store_resolve_entry(entry, config.get('resolve_cache_path'))
+    return entry
+
+def remember_listed(posts, config):
+    # Si el listado ya trae la URL del archivo (APIs JSON) no hace falta visitar el post
+    for post in posts:
+        if post.get('download_url') and lookup_resolved(post['post_url']) is None:
+            entry = remember_resolved(post['post_url'], post['download_url'], config, store=False)
+            entry.update(size=post.get('size'), md5=post.get('md5'))
+            store_resolve_entry(entry, config.get('resolve_cache_path'))
+
+def resolve_post(file_url, config, probe=False):
+    post_url = normalize_post_url(file_url, config['base_url'])
+    entry = lookup_resolved(post_url)
+    if entry is None:
+        download_url = fetch_post_download_url(post_url, config)
+        entry = remember_resolved(post_url, download_url, config, store=not probe)
+        if entry is None:
+            return None
+
+    if probe and entry['size'] is None:
+        info = probe_file(entry['download_url'])
+        if info:
+            entry = dict(entry, **info)
+        store_resolve_entry(entry, config.get('resolve_cache_path'))
+    return entry
+
+def open_journal(path):
+    global journal
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS posts (
+        post_url TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        download_url TEXT,
+        filepath TEXT,
+        bytes_done INTEGER DEFAULT 0,
+        total_bytes INTEGER,
+        error TEXT,
+        updated_at REAL
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS searches (
+        search_url TEXT PRIMARY KEY,
+        total_pages INTEGER,
+        completed INTEGER DEFAULT 0,
+        newest_post_id INTEGER,
+        updated_at REAL
+    )''')
+    # Diarios creados por versiones anteriores no tienen newest_post_id
+    columns = {row['name'] for row in conn.execute('PRAGMA table_info(searches)')}
+    if 'newest_post_id' not in columns:
+        conn.execute('ALTER TABLE searches ADD COLUMN newest_post_id INTEGER')
+    conn.execute('''CREATE TABLE IF NOT EXISTS pages (
+        search_url TEXT,
+        page INTEGER,
+        crawled_at REAL,
+        PRIMARY KEY (search_url, page)
+    )''')
+    # Un mismo post puede aparecer en varias búsquedas
+    conn.execute('''CREATE TABLE IF NOT EXISTS search_posts (
+        search_url TEXT,
+        page INTEGER,
+        position INTEGER,
+        post_url TEXT,
+        PRIMARY KEY (search_url, post_url)
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS search_posts_by_page ON search_posts (search_url, page, position)')
+    # Índice del almacén por contenido: qué tenemos guardado y de qué URL salió cada cosa
+    conn.execute('''CREATE TABLE IF NOT EXISTS blobs (
+        sha256 TEXT PRIMARY KEY,
+        md5 TEXT,
+        size INTEGER,
+        stored_at REAL
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS blobs_by_md5 ON blobs (md5)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS blob_urls (
+        url TEXT PRIMARY KEY,
+        sha256 TEXT NOT NULL
+    )''')
+    with journal_lock:
+        journal = conn
+    return conn
+
+def journal_query(sql, params=(), fetch=False):
+    # Todas las funciones del diario son no-op si no se ha abierto (p. ej. en los benchmarks)
+    if journal is None:
+        return [] if fetch else None
+    with journal_lock:
+        cursor = journal.execute(sql, params)
+        if fetch:
+            return cursor.fetchall()
+    return None
+
+def journal_get(post_url):
+    rows = journal_query('SELECT * FROM posts WHERE post_url = ?', (post_url,), fetch=True)
+    return dict(rows[0]) if rows else None
+
+def journal_mark(post_url, state, **fields):
+    assert state in JOURNAL_STATES
+    fields['state'] = state
+    fields['updated_at'] = time.time()
+    # Los campos van también en el INSERT: un post resuelto desde el listado aún no tiene fila
+    columns = ', '.join(fields)
+    placeholders = ', '.join('?' for _ in fields)
+    updates = ', '.join(f'{name} = excluded.{name}' for name in fields)
+    journal_query(
+        f'INSERT INTO posts (post_url, {columns}) VALUES (?, {placeholders}) ON CONFLICT(post_url) DO UPDATE SET {updates}',
+        (post_url,) + tuple(fields.values()),
+    )
+
+def journal_record_page(search_url, page, post_urls):
+    now = time.time()
+    with journal_lock:
+        if journal is None:
+            return
+        journal.execute('BEGIN')
+        journal.executemany(
+            'INSERT OR IGNORE INTO posts (post_url, state, updated_at) VALUES (?, ?, ?)',
+            [(post_url, 'discovered', now) for post_url in post_urls],
+        )
+        journal.executemany(
+            'INSERT OR REPLACE INTO search_posts (search_url, page, position, post_url) VALUES (?, ?, ?, ?)',
+            [(search_url, page, position, post_url) for position, post_url in enumerate(post_urls)],
+        )
+        journal.execute('INSERT OR REPLACE INTO pages (search_url, page, crawled_at) VALUES (?, ?, ?)', (search_url, page, now))
+        journal.execute('COMMIT')
+
+def journal_start_crawl(search_url, total_pages):
+    # Si la última pasada terminó empezamos de nuevo; si se cortó, conservamos las páginas ya leídas
+    rows = journal_query('SELECT completed FROM searches WHERE search_url = ?', (search_url,), fetch=True)
+    if rows and rows[0]['completed']:
+        journal_query('DELETE FROM pages WHERE search_url = ?', (search_url,))
+    journal_query(
+        'INSERT INTO searches (search_url, total_pages, completed, updated_at) VALUES (?, ?, 0, ?) '
+        'ON CONFLICT(search_url) DO UPDATE SET total_pages = excluded.total_pages, completed = 0, updated_at = excluded.updated_at',
+        (search_url, total_pages, time.time()),
+    )
+    rows = journal_query('SELECT page FROM pages WHERE search_url = ?', (search_url,), fetch=True)
+    return {row['page'] for row in rows}
+
+def journal_page_posts(search_url, page):
+    rows = journal_query('SELECT post_url FROM search_posts WHERE search_url = ? AND page = ? ORDER BY position', (search_url, page), fetch=True)
+    return [row['post_url'] for row in rows]
+
+def journal_finish_crawl(search_url):
+    journal_query('UPDATE searches SET completed = 1, updated_at = ? WHERE search_url = ?', (time.time(), search_url))
+
+def journal_known_posts(post_urls):
+    # Solo cuenta como conocido lo ya descargado: lo fallido o a medias se vuelve a intentar
+    if not post_urls:
+        return set()
+    placeholders = ', '.join('?' for _ in post_urls)
+    rows = journal_query(
+        f"SELECT post_url FROM posts WHERE state = 'done' AND post_url IN ({placeholders})",
+        tuple(post_urls),
+        fetch=True,
+    )
+    return {row['post_url'] for row in rows}
+
+def journal_unfinished_posts(search_url):
+    # Posts de la búsqueda que una pasada anterior no llegó a descargar, en el orden del listado
+    rows = journal_query(
+        'SELECT search_posts.post_url FROM search_posts JOIN posts USING (post_url) '
+        "WHERE search_posts.search_url = ? AND posts.state != 'done' ORDER BY search_posts.page, search_posts.position",
+        (search_url,), fetch=True,
+    )
+    return [row['post_url'] for row in rows]
+
+def journal_search_completed(search_url):
+    # El modo sincronización solo tiene sentido si alguna pasada llegó al final de la búsqueda;
+    # si la última se cortó (o falló una página) toca seguir recorriéndola entera
+    rows = journal_query('SELECT completed FROM searches WHERE search_url = ?', (search_url,), fetch=True)
+    return bool(rows and rows[0]['completed'])
+
+def journal_newest_post_id(search_url):
+    rows = journal_query('SELECT newest_post_id FROM searches WHERE search_url = ?', (search_url,), fetch=True)
+    return rows[0]['newest_post_id'] if rows else None
+
+def journal_update_newest_post_id(search_url):
+    # Marca de sincronización: el mayor ID hasta el que todos los posts de la búsqueda están descargados.
+    # Se recalcula al terminar cada ejecución con lo que dice el diario, así un post fallido o a medias
+    # nunca queda por debajo. Solo con la búsqueda recorrida entera: con páginas sin leer no sabemos
+    # qué posts faltan. Si no sale ninguno se conserva la anterior
+    rows = journal_query(
+        'SELECT search_posts.post_url, posts.state FROM search_posts JOIN posts USING (post_url) WHERE search_posts.search_url = ?',
+        (search_url,), fetch=True,
+    )
+    posts = [(extract_post_id(row['post_url']), row['state'] == 'done') for row in rows]
+    unfinished = min((post_id for post_id, done in posts if post_id is not None and not done), default=math.inf)
+    newest = max((post_id for post_id, done in posts if post_id is not None and done and post_id < unfinished), default=None)
+    if newest is not None:
+        journal_query(
+            'UPDATE searches SET newest_post_id = ?, updated_at = ? WHERE search_url = ? AND completed = 1',
+            (newest, time.time(), search_url),
+        )
+    return newest
+
+def journal_find_blob(url=None, md5=None):
+    # Busca por URL y, si no, por el MD5 que da el booru; devuelve (sha256, md5) o None
+    rows = []
+    if url:
+        rows = journal_query(
+            'SELECT blobs.sha256, blobs.md5 FROM blob_urls JOIN blobs USING (sha256) WHERE blob_urls.url = ?',
+            (url,), fetch=True,
+        )
+    if not rows and md5:
+        rows = journal_query('SELECT sha256, md5 FROM blobs WHERE md5 = ?', (md5.lower(),), fetch=True)
+    return (rows[0]['sha256'], rows[0]['md5']) if rows else None
+
+def journal_add_blob(url, sha256, md5, size):
+    with journal_lock:
+        if journal is None:
+            return
+        journal.execute('BEGIN')
+        journal.execute(
+            'INSERT OR IGNORE INTO blobs (sha256, md5, size, stored_at) VALUES (?, ?, ?, ?)',
+            (sha256, md5, size, time.time()),
+        )
+        journal.execute('INSERT OR REPLACE INTO blob_urls (url, sha256) VALUES (?, ?)', (url, sha256))
+        journal.execute('COMMIT')
+
+def extract_post_id(post_url):
+    # El ID es el parámetro id en los index.php?page=post&s=view&id=1234 y si no el último tramo
+    # numérico de la ruta (/posts/1234, /post/show/1234/etiquetas). El resto de la consulta y las
+    # etiquetas no cuentan aunque lleven números (/posts/1234?q=1girl)
+    parsed = urlparse(post_url)
+    post_id = parse_qs(parsed.query).get('id', [''])[0]
+    if post_id.isdigit():
+        return int(post_id)
+    segments = [segment for segment in parsed.path.split('/') if segment.isdigit()]
+    if segments:
+        return int(segments[-1])
+    numbers = re.findall(r'\d+', parsed.path)
+    return int(numbers[-1]) if numbers else None
+
+def journal_done_filepath(post_url):
+    # Devuelve la ruta si el post ya está descargado y el archivo sigue en disco
+    record = journal_get(post_url)
+    if record and record['state'] == 'done' and record['filepath'] and os.path.exists(record['filepath']):
+        return record['filepath']
+    return None
+
+def fetch_search_page(config, page):
+    resolver = get_resolver(config)
+    page_url = resolver.page_url(config, page)
+    tqdm.write(f"Accediendo a la página: {page_url}")
+    text = fetch_page(page_url, 'first_page' if page == 1 else 'page')
+    if text is None:
+        # None y no []: una página que no se pudo leer no es una página vacía
+        return None
+    posts = parse_html(resolver.parse_page, config, text)
+    remember_listed(posts, config)
+    return [post['post_url'] for post in posts]
+
+def iter_new_posts(config):
+    # Modo sincronización: las búsquedas vienen ordenadas de más nuevo a más antiguo,
+    # así que paramos en cuanto una página entera son posts que ya conocíamos.
+    # Antes va lo que quedó fallido o a medias en pasadas anteriores, esté en la página que esté
+    search_url = config['search_url']
+    unfinished = journal_unfinished_posts(search_url)
+    yield from unfinished
+    earlier = set(unfinished)
+    seen = set(earlier)
+    new_posts = 0
+    page = 1
+    while not stop_event.is_set():
+        post_urls = fetch_search_page(config, page)
+        if post_urls is None:
+            if stop_event.is_set():
+                break
+            raise PageFetchError(f"No se pudo leer la página {page} de {search_url}")
+        if not post_urls:
+            break
+        known = journal_known_posts(post_urls)
+        journal_record_page(search_url, page, post_urls)
+        for post_url in post_urls:
+            if post_url not in known and post_url not in seen:
+                seen.add(post_url)
+                new_posts += 1
+                yield post_url
+        # Un post que sigue fallando no es nuevo: no nos hace recorrer la búsqueda entera
+        if all(post_url in known or post_url in earlier for post_url in post_urls):
+            break
+        page += 1
+    tqdm.write(f"Sincronización: {page} páginas leídas, {new_posts} posts nuevos, {len(unfinished)} pendientes de antes.")
+
+def iter_search_posts(config):
+    # Genera los posts página a página, para que las descargas empiecen sin esperar al final
+    if config.get('sync'):
+        yield from iter_new_posts(config)
+        return
+    search_url = config['search_url']
+    total_pages = get_total_pages(config)
+    crawled_pages = journal_start_crawl(search_url, total_pages)
+    crawl_workers = config.get('crawl_workers', CRAWL_WORKERS)
+    # Pedimos varias páginas a la vez, pero solo unas pocas por delante de la que estamos entregando
+    window = crawl_workers * 2
+    # Sin total (algunas APIs) seguimos hasta la primera página vacía
+    last_page = math.inf if total_pages is None else total_pages
+
+    # En búsquedas activas los resultados se desplazan mientras paginamos y un post puede salir en dos páginas
+    seen = set()
+    pending = {}
+    failed_pages = []
+    submitted = 0
+    page = 0
+    with ThreadPoolExecutor(max_workers=crawl_workers) as executor:
+        while page < last_page:
+            page += 1
+            if stop_event.is_set():
+                for future in pending.values():
+                    future.cancel()
+                return
+            while submitted < last_page and submitted < page + window:
+                submitted += 1
+                if submitted not in crawled_pages:
+                    pending[submitted] = executor.submit(fetch_search_page, config, submitted)
+            if page in crawled_pages:
+                post_urls = journal_page_posts(search_url, page)
+            else:
+                post_urls = pending.pop(page).result()
+                if post_urls is None:
+                    if stop_event.is_set():
+                        for future in pending.values():
+                            future.cancel()
+                        return
+                    # Sin registrar la página: la próxima pasada la vuelve a pedir. Con total seguimos
+                    # con las demás; sin él no sabemos si la búsqueda acababa aquí y paramos
+                    failed_pages.append(page)
+                    if total_pages is None:
+                        for future in pending.values():
+                            future.cancel()
+                        break
+                    continue
+                journal_record_page(search_url, page, post_urls)
+            # Sin total solo un listado vacío de verdad marca el final
+            if not post_urls and total_pages is None:
+                for future in pending.values():
+                    future.cancel()
+                break
+            for post_url in post_urls:
+                if post_url in seen:
+                    continue
+                seen.add(post_url)
+                yield post_url
+    if failed_pages:
+        raise PageFetchError(crawl_error(search_url, failed_pages))
+    journal_finish_crawl(search_url)
+
+def crawl_error(search_url, failed_pages):
+    pages = ', '.join(str(page) for page in failed_pages)
+    pages = f"la página {pages}" if len(failed_pages) == 1 else f"las páginas {pages}"
+    return f"No se pudo leer {pages} de {search_url}; la búsqueda se seguirá en la próxima pasada"
+
+def crawl_search(config):
+    file_urls = []
+    try:
+        for file_url in iter_search_posts(config):
+            file_urls.append(file_url)
+    except PageFetchError as e:
+        print(e)
+    return file_urls
 
 def format_size(size_bytes):
     if size_bytes == 0:
@@ -104,11 +1943,15 @@ def calculate_total_size(file_urls, config):
     print("Calculando el tamaño total de la descarga...")
 
     def process_file(file_url):
-        if not file_url.startswith(('http://', 'https://')):
-            file_url = config['base_url'] + file_url
-        download_url = get_download_url(file_url, config['download_link_selector'], config['base_url'])
-        if download_url:
-            return get_file_size(download_url)
+        if journal_done_filepath(normalize_post_url(file_url, config['base_url'])):
+            return 0
+        # Lo que ya tenemos por MD5 no se va a descargar: ni siquiera hace falta sondearlo
+        entry = resolve_post(file_url, config)
+        if entry and journal_find_blob(md5=entry.get('md5') or extract_url_md5(entry['download_url'])):
+            return 0
+        entry = resolve_post(file_url, config, probe=True)
+        if entry:
+            return entry['size'] or 0
         return 0
 
     with ThreadPoolExecutor(max_workers=10) as executor:
@@ -118,89 +1961,1440 @@ def calculate_total_size(file_urls, config):
     print("\nCálculo completado.")
     return total_size
 
-def download_file(url, folder, retries=MAX_RETRIES):
+def read_part_meta(meta_path):
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_part_meta(meta_path, meta):
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+def discard_part(part_path, meta_path):
+    for path in (part_path, meta_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+def parse_content_range(value):
+    match = re.match(r'bytes\s+(\d+)-(\d+)/(\d+|\*)', value or '')
+    if not match:
+        return None
+    start, end, total = match.groups()
+    return int(start), int(end), int(total) if total != '*' else None
+
+def set_output_layout(layout):
+    global output_layout
+    layout = layout or DEFAULT_LAYOUT
+    try:
+        layout.format(**{field: field for field in LAYOUT_FIELDS})
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(f"Formato de salida no válido: {layout} (campos: {', '.join(LAYOUT_FIELDS)})") from e
+    output_layout = layout
+
+def set_md5_patterns(patterns):
+    global md5_patterns
+    if patterns is None:
+        patterns = MD5_URL_PATTERNS
+    md5_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+
+def extract_url_md5(url):
+    path = urlparse(url).path
+    for pattern in md5_patterns:
+        match = pattern.search(path)
+        if match:
+            return match.group(1).lower()
+    return None
+
+def objects_folder(folder):
+    return os.path.join(folder, STATE_FOLDER, OBJECTS_FOLDER)
+
+def blob_path_for(sha256, folder):
+    return os.path.join(objects_folder(folder), sha256[:2], sha256)
+
+def part_path_for(url, folder):
+    # Los .part van por URL y no por nombre, para que dos archivos que se llaman igual no se mezclen
+    return os.path.join(objects_folder(folder), 'tmp', hashlib.sha1(url.encode()).hexdigest() + '.part')
+
+def layout_path_for(url, folder, sha256, md5):
+    filename = url.split('/')[-1]
+    name, ext = os.path.splitext(filename)
+    return os.path.join(folder, output_layout.format(filename=filename, name=name, ext=ext, sha256=sha256, md5=md5))
+
+def new_hashers(part_path=None, offset=0):
+    # El hash se calcula en el mismo bucle que escribe los trozos; al reanudar solo hay que
+    # pasar una vez por lo que ya estaba en el .part
+    hashers = (hashlib.sha256(), hashlib.md5())
+    if offset:
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                for hasher in hashers:
+                    hasher.update(chunk)
+    return hashers
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def link_file(source, target):
+    # Enlace duro si se puede; si no (otro sistema de archivos, FAT...), reflink y si tampoco, copia
+    try:
+        os.link(source, target)
+        return
+    except OSError:
+        pass
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, target)
+
+def place_blob(sha256, md5, url, folder):
+    blob_path = blob_path_for(sha256, folder)
+    target = layout_path_for(url, folder, sha256, md5)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.exists(target):
+        if os.path.samefile(target, blob_path):
+            return target
+        if os.path.getsize(target) == os.path.getsize(blob_path) and file_sha256(target) == sha256:
+            return target
+        # Otro archivo distinto con el mismo nombre: no lo pisamos, le añadimos el hash
+        name, ext = os.path.splitext(target)
+        target = f'{name}_{sha256[:8]}{ext}'
+        if os.path.exists(target):
+            return target
+    link_file(blob_path, target)
+    return target
+
+def find_stored(url, folder, md5=None):
+    # Si ya tenemos el contenido (por esta URL o por el MD5 del booru) no hace falta ir a la red
+    found = journal_find_blob(url, md5)
+    if found and os.path.exists(blob_path_for(found[0], folder)):
+        return place_blob(found[0], found[1], url, folder)
+    return None
+
+def adopt_existing(url, folder, expected_size=None, md5=None):
+    # Un archivo que ya está en su sitio (de antes del almacén, de otra carpeta copiada...) se mete en
+    # el almacén en vez de volver a bajarlo, si coincide con el MD5 del booru o, sin MD5, con el tamaño
+    fields = {field for _, field, _, _ in string.Formatter().parse(output_layout) if field}
+    if 'sha256' in fields or ('md5' in fields and not md5):
+        return None
+    target = layout_path_for(url, folder, None, md5)
+    if not os.path.isfile(target):
+        return None
+    size = os.path.getsize(target)
+    if not size or (not md5 and size != expected_size):
+        return None
+    sha256, file_md5 = (hasher.hexdigest() for hasher in new_hashers(target, size))
+    if md5 and file_md5 != md5.lower():
+        return None
+    blob_path = blob_path_for(sha256, folder)
+    if not os.path.exists(blob_path):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        link_file(target, blob_path)
+    journal_add_blob(url, sha256, file_md5, size)
+    return target
+
+def store_part(part_path, url, folder, hashers, expected_md5=None):
+    sha256, md5 = (hasher.hexdigest() for hasher in hashers)
+    # Más fiable que comparar el tamaño: si el booru nos dio el MD5, tiene que coincidir
+    if expected_md5 and md5 != expected_md5.lower():
+        discard_part(part_path, part_path + '.json')
+        raise Exception(f"El MD5 del archivo descargado ({md5}) no coincide con el esperado ({expected_md5}).")
+    blob_path = blob_path_for(sha256, folder)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    size = os.path.getsize(part_path)
+    if os.path.exists(blob_path):
+        # El mismo contenido ya había llegado por otra URL
+        os.remove(part_path)
+    else:
+        os.replace(part_path, blob_path)
+    journal_add_blob(url, sha256, md5, size)
+    return place_blob(sha256, md5, url, folder)
+
+def finish_part(url, folder, part_path, meta_path, hashers, total_size, md5=None):
+    if total_size and os.path.getsize(part_path) != total_size:
+        raise Exception("El tamaño del archivo descargado no coincide con el tamaño esperado.")
+    filepath = store_part(part_path, url, folder, hashers, md5)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    return filepath
+
+def part_bytes_done(part_path):
+    # Con segmentos el .part está reservado entero; lo bajado de verdad se apunta en su .json
+    meta = read_part_meta(part_path + '.json')
+    if meta.get('segments'):
+        return sum(segment[2] for segment in meta['segments'])
+    return os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+def preallocate(f, offset, total_size, minimum=PREALLOCATE_MIN):
+    # posix_fallocate agranda el archivo: quien llame tiene que recortarlo a lo escrito al cerrar
+    if not hasattr(os, 'posix_fallocate') or not total_size or total_size - offset < minimum:
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), offset, total_size - offset)
+        return True
+    except OSError:
+        # Sistemas de archivos que no lo soportan; se escribe igual, sin reservar
+        return False
+
+def get_read_buffer():
+    buffer = getattr(read_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = read_buffers.buffer = bytearray(READ_CHUNK_MAX)
+    return buffer
+
+def read_chunks(response, buffer):
+    # Vistas (sin copiar) sobre el búfer; cada una solo vale hasta pedir la siguiente
+    view = memoryview(buffer)
+    response.raw.decode_content = True
+    chunk = READ_CHUNK_MIN
+    while True:
+        started = time.monotonic()
+        size = response.raw.readinto(view[:chunk])
+        if not size:
+            return
+        elapsed = time.monotonic() - started
+        yield view[:size]
+        if elapsed > READ_CHUNK_SLOW:
+            chunk = max(chunk // 2, READ_CHUNK_MIN)
+        elif size == chunk and elapsed < READ_CHUNK_SLOW / 4:
+            chunk = min(chunk * 2, len(buffer))
+
+def use_segments(response, url, total_size):
+    # pwrite no existe en Windows; allí los archivos grandes van de una pieza
+    return (
+        hasattr(os, 'pwrite')
+        and total_size >= SEGMENT_MIN_SIZE
+        and min(SEGMENTS, HOST_CONNECTIONS.get(get_host(url), DEFAULT_HOST_CONNECTIONS)) > 1
+        and response.headers.get('accept-ranges', '').lower() == 'bytes'
+        and response.headers.get('content-encoding', 'identity') == 'identity'
+    )
+
+def plan_segments(url, total_size):
+    # [inicio, fin, bytes ya escritos] de cada segmento, con el fin incluido como en Range
+    count = min(SEGMENTS, HOST_CONNECTIONS.get(get_host(url), DEFAULT_HOST_CONNECTIONS))
+    step = -(-total_size // count)
+    return [[start, min(start + step, total_size) - 1, 0] for start in range(0, total_size, step)]
+
+def write_at(fd, data, position):
+    # pwrite no mueve el puntero del archivo, así que los segmentos no se pisan entre hilos
+    clock = profile_clock()
+    while data:
+        written = os.pwrite(fd, data, position)
+        data = data[written:]
+        position += written
+    if clock:
+        profile_add('escritura', clock)
+
+def write_chunk(f, chunk, hashers):
+    clock = profile_clock()
+    size = f.write(chunk)
+    for hasher in hashers:
+        hasher.update(chunk)
+    if clock:
+        profile_add('escritura', clock)
+    return size
+
+def download_segment(url, fd, segment, validator, progress_bar, retries=MAX_RETRIES):
+    # Cada segmento se reintenta por su cuenta, desde lo que ya llevara escrito
+    buffer = get_read_buffer()
+    for attempt in range(retries):
+        position = segment[0] + segment[2]
+        headers = {'Range': f'bytes={position}-{segment[1]}'}
+        if validator:
+            headers['If-Range'] = validator
+        pending = 0
+        last_update = time.monotonic()
+        try:
+            with host_slot(url), limited_request('get', url, headers=headers, stream=True) as r:
+                r.raise_for_status()
+                content_range = parse_content_range(r.headers.get('content-range'))
+                if r.status_code != 206 or not content_range or content_range[0] != position:
+                    # Con If-Range, una respuesta entera quiere decir que el archivo ha cambiado
+                    raise RangeMismatch()
+                for chunk in read_chunks(r, buffer):
+                    if stop_event.is_set():
+                        raise DownloadCancelled()
+                    chunk = chunk[:segment[1] + 1 - position]
+                    write_at(fd, chunk, position)
+                    position += len(chunk)
+                    segment[2] += len(chunk)
+                    pending += len(chunk)
+                    now = time.monotonic()
+                    if now - last_update >= PROGRESS_INTERVAL:
+                        update_progress(progress_bar, pending)
+                        record_metric_bytes(url, pending)
+                        pending = 0
+                        last_update = now
+                    delay = bandwidth_delay(url, len(chunk))
+                    if delay > 0:
+                        stop_event.wait(delay)
+                    if position > segment[1]:
+                        break
+            if position <= segment[1]:
+                raise Exception(f"El segmento {segment[0]}-{segment[1]} llegó incompleto.")
+            return
+        except (DownloadCancelled, RangeMismatch):
+            raise
+        except Exception as e:
+            if attempt < retries - 1 and is_retryable(e) and not stop_event.is_set():
+                record_metric_retry()
+                stop_event.wait(retry_delay(attempt, e))
+            else:
+                raise
+        finally:
+            if pending:
+                update_progress(progress_bar, pending)
+                record_metric_bytes(url, pending)
+
+def download_segments(url, part_path, meta_path, meta, progress=None):
+    # Los segmentos van cada uno en su hilo y cogen su hueco de host_slot como cualquier descarga;
+    # este hilo solo espera, sin ocupar ninguno, para no bloquear a los segmentos de otros archivos
+    total_size = meta['total']
+    if not os.path.exists(part_path):
+        for segment in meta['segments']:
+            segment[2] = 0
+    etag = meta.get('etag')
+    validator = etag if etag and not etag.startswith('W/') else meta.get('last_modified')
+    done = sum(segment[2] for segment in meta['segments'])
+    if progress is None:
+        progress_bar = tqdm(
+            desc=url.split('/')[-1],
+            total=total_size,
+            initial=done,
+            unit='iB',
+            unit_scale=True,
+            unit_divisor=1024,
+            dynamic_ncols=True
+        )
+    else:
+        progress_bar = progress
+    pending = [segment for segment in meta['segments'] if segment[0] + segment[2] <= segment[1]]
+    try:
+        with open(part_path, 'r+b' if os.path.exists(part_path) else 'w+b') as f:
+            preallocate(f, 0, total_size, minimum=0)
+            f.truncate(total_size)
+            with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+                # Cada segmento hereda la etapa de quien lo lanza, para que sus peticiones cuenten en ella
+                futures = [
+                    executor.submit(contextvars.copy_context().run, download_segment, url, f.fileno(), segment, validator, progress_bar)
+                    for segment in pending
+                ]
+                errors = [future.exception() for future in futures]
+    finally:
+        # Lo que lleve cada segmento queda apuntado para reanudar
+        write_part_meta(meta_path, meta)
+        if progress is None:
+            progress_bar.close()
+
+    errors = [error for error in errors if error is not None]
+    if any(isinstance(error, RangeMismatch) for error in errors):
+        if progress is not None:
+            update_progress(progress, -sum(segment[2] for segment in meta['segments']))
+        discard_part(part_path, meta_path)
+        raise Exception("El archivo ha cambiado en el servidor; se reinicia la descarga.")
+    if any(isinstance(error, DownloadCancelled) for error in errors):
+        raise DownloadCancelled()
+    if errors:
+        raise errors[0]
+    # Escritos fuera de orden: el hash se calcula al final, de una pasada
+    return new_hashers(part_path, total_size)
+
+def download_file(url, folder, retries=MAX_RETRIES, progress=None, expected_size=None, md5=None):
+    # Si nos pasan una barra compartida la usamos; si no, cada archivo tiene la suya
     local_filename = url.split('/')[-1]
-    filepath = os.path.join(folder, local_filename)
+    filepath = find_stored(url, folder, md5) or adopt_existing(url, folder, expected_size, md5)
+    if filepath:
+        return filepath
+    # Descargamos a un .part y solo lo pasamos al almacén al final si todo ha ido bien;
+    # en <.part>.json guardamos ETag/Last-Modified para poder reanudar
+    part_path = part_path_for(url, folder)
+    meta_path = part_path + '.json'
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    host = get_host(url)
+    counted = 0
     
     for attempt in range(retries):
         try:
-            with requests.get(url, stream=True, timeout=30) as r:
+            meta = read_part_meta(meta_path)
+            if meta.get('segments') and meta.get('url') == url:
+                # Descarga por segmentos a medias: sigue igual, cada segmento desde donde iba
+                hashers = download_segments(url, part_path, meta_path, meta, progress)
+                return finish_part(url, folder, part_path, meta_path, hashers, meta['total'], md5)
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if offset and meta.get('url') != url:
+                discard_part(part_path, meta_path)
+                offset = 0
+                meta = {}
+
+            headers = {}
+            with host_range_lock:
+                accepts_ranges = host_range_support.get(host, True)
+            if offset and accepts_ranges:
+                headers['Range'] = f'bytes={offset}-'
+                # If-Range: si el archivo ha cambiado en el servidor nos devuelve el archivo entero
+                etag = meta.get('etag')
+                validator = etag if etag and not etag.startswith('W/') else meta.get('last_modified')
+                if validator:
+                    headers['If-Range'] = validator
+
+            with host_slot(url), limited_request('get', url, headers=headers, stream=True) as r:
+                if r.status_code == 416:
+                    # Nuestro .part no encaja con lo que tiene el servidor: empezamos de cero
+                    discard_part(part_path, meta_path)
+                    raise Exception("El servidor rechazó el rango pedido; se reinicia la descarga.")
                 r.raise_for_status()
-                total_size = int(r.headers.get('content-length', 0))
+                with host_range_lock:
+                    host_range_support[host] = r.headers.get('accept-ranges', '').lower() == 'bytes' or r.status_code == 206
+
+                etag = r.headers.get('etag')
+                if r.status_code == 206:
+                    content_range = parse_content_range(r.headers.get('content-range'))
+                    if not content_range or content_range[0] != offset:
+                        discard_part(part_path, meta_path)
+                        raise Exception("El Content-Range de la respuesta no coincide con lo ya descargado.")
+                    if meta.get('etag') and etag and etag != meta['etag']:
+                        discard_part(part_path, meta_path)
+                        raise Exception("El archivo ha cambiado en el servidor (ETag distinto).")
+                    total_size = content_range[2] or offset + int(r.headers.get('content-length', 0))
+                    mode = 'r+b'
+                else:
+                    # Respuesta completa: lo que hubiera en el .part ya no sirve
+                    offset = 0
+                    total_size = int(r.headers.get('content-length', 0))
+                    mode = 'wb'
+                    if progress is not None and counted:
+                        update_progress(progress, -counted)
+                        counted = 0
+                    meta = {
+                        'url': url,
+                        'etag': etag,
+                        'last_modified': r.headers.get('last-modified'),
+                        'total': total_size,
+                    }
+                    if use_segments(r, url, total_size):
+                        meta['segments'] = plan_segments(url, total_size)
+                    write_part_meta(meta_path, meta)
                 
-                with open(filepath, 'wb') as f, tqdm(
-                    desc=local_filename,
-                    total=total_size,
-                    unit='iB',
-                    unit_scale=True,
-                    unit_divisor=1024,
-                    dynamic_ncols=True
-                ) as progress_bar:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:
-                            size = f.write(chunk)
-                            progress_bar.update(size)
+                if not meta.get('segments'):
+                    if progress is None:
+                        progress_bar = tqdm(
+                            desc=local_filename,
+                            total=total_size,
+                            initial=offset,
+                            unit='iB',
+                            unit_scale=True,
+                            unit_divisor=1024,
+                            dynamic_ncols=True
+                        )
+                    else:
+                        progress_bar = progress
+                    hashers = new_hashers(part_path, offset)
+                    pending = 0
+                    last_update = time.monotonic()
+                    try:
+                        with open(part_path, mode) as f:
+                            f.seek(offset)
+                            preallocated = preallocate(f, offset, total_size)
+                            try:
+                                for chunk in read_chunks(r, get_read_buffer()):
+                                    if stop_event.is_set():
+                                        raise DownloadCancelled()
+                                    size = write_chunk(f, chunk, hashers)
+                                    pending += size
+                                    now = time.monotonic()
+                                    if now - last_update >= PROGRESS_INTERVAL:
+                                        update_progress(progress_bar, pending)
+                                        record_metric_bytes(url, pending)
+                                        counted += pending
+                                        pending = 0
+                                        last_update = now
+                                    delay = bandwidth_delay(url, size)
+                                    if delay > 0:
+                                        stop_event.wait(delay)
+                            finally:
+                                if preallocated:
+                                    # Lo reservado y no escrito fuera, para que el .part mida lo descargado
+                                    f.truncate(f.tell())
+                    finally:
+                        if pending:
+                            update_progress(progress_bar, pending)
+                            record_metric_bytes(url, pending)
+                            counted += pending
+                        if progress is None:
+                            progress_bar.close()
             
-            if os.path.getsize(filepath) != total_size:
+            if meta.get('segments'):
+                # Grande y con rangos: soltamos esta conexión y lo bajamos por segmentos en paralelo
+                hashers = download_segments(url, part_path, meta_path, meta, progress)
+            # Sin Content-Length nos queda el tamaño que vimos al sondear
+            return finish_part(url, folder, part_path, meta_path, hashers, total_size or expected_size, md5)
+        except DownloadCancelled:
+            # Dejamos el .part en su sitio para reanudar en la próxima ejecución
+            return None
+        except Exception as e:
+            if stop_event.is_set():
+                return None
+            if attempt < retries - 1 and is_retryable(e):
+                record_metric_retry()
+                delay = retry_delay(attempt, e)
+                tqdm.write(f"Error al descargar {url}: {e}. Reintentando en {delay:.1f} segundos...")
+                stop_event.wait(delay)
+            else:
+                tqdm.write(f"Error al descargar {url} después de {attempt + 1} intentos: {e}")
+                return None
+    return None
+
+def prepare_post(file_url, config):
+    # Devuelve (entrada, None) si hay que descargarlo, (None, ruta) si ya estaba y (None, None) si falla
+    post_url = normalize_post_url(file_url, config['base_url'])
+    filepath = journal_done_filepath(post_url)
+    if filepath:
+        return None, filepath
+    entry = resolve_post(post_url, config)
+    if not entry:
+        tqdm.write(f"No se pudo encontrar el enlace de descarga para {file_url}")
+    return entry, None
+
+def fetch_post(entry, folder, progress=None):
+    post_url = entry['post_url']
+    download_url = entry['download_url']
+    part_path = part_path_for(download_url, folder)
+    journal_mark(post_url, 'downloading', bytes_done=part_bytes_done(part_path), total_bytes=entry['size'])
+    md5 = entry.get('md5') or extract_url_md5(download_url)
+    with metric_stage('descarga', download_url):
+        filepath = download_file(download_url, folder, progress=progress, expected_size=entry['size'], md5=md5)
+    if filepath:
+        size = os.path.getsize(filepath)
+        journal_mark(post_url, 'done', filepath=filepath, bytes_done=size, total_bytes=size, error=None)
+    else:
+        bytes_done = part_bytes_done(part_path)
+        if stop_event.is_set():
+            # Interrumpido: sigue "en curso" y se reanudará desde bytes_done
+            journal_mark(post_url, 'downloading', bytes_done=bytes_done)
+        else:
+            journal_mark(post_url, 'failed', bytes_done=bytes_done, error='descarga fallida')
+            tqdm.write(f"No se pudo descargar el archivo desde {download_url}")
+    return filepath
+
+def new_search_stats(configs):
+    stats = {'encontrados': 0, 'descargados': 0, 'fallidos': 0, 'repetidos': 0}
+    stats['busquedas'] = [dict(stats, search_url=config['search_url']) for config in configs]
+    return stats
+
+def count_search_stat(stats, key, index):
+    # Suma al total y a la búsqueda; devuelve lo que se enseña en la barra de progreso
+    stats[key] += 1
+    stats['busquedas'][index][key] += 1
+    record_metric_post(key)
+    postfix = {
+        'archivos': f"{stats['descargados']}/{stats['encontrados']}",
+        'fallos': stats['fallidos'],
+    }
+    if stats['repetidos']:
+        postfix['repetidos'] = stats['repetidos']
+    return postfix
+
+def queue_put(work_queue, item):
+    # put con espera corta para poder salir si se interrumpe el programa
+    while not stop_event.is_set():
+        try:
+            work_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def start_threads(target, count, name):
+    threads = [threading.Thread(target=target, name=f'{name}-{i}', daemon=True) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+def run_pipeline(configs, folder, file_urls=None):
+    # Búsqueda -> resolución -> descarga unidas por colas acotadas: si las descargas van lentas
+    # las colas se llenan y el crawler espera, así la memoria no crece con el tamaño de la búsqueda.
+    # Con varias búsquedas cada una tiene su crawler y su cola, y un repartidor las va turnando
+    # según su peso ('weight') hacia los mismos hilos de resolución y descarga
+    resolve_workers = configs[0].get('resolve_workers', RESOLVE_WORKERS)
+    download_workers = configs[0].get('download_workers', DOWNLOAD_WORKERS)
+    queue_size = configs[0].get('queue_size', QUEUE_SIZE)
+    active_searches = configs[0].get('active_searches', ACTIVE_SEARCHES)
+    file_urls = file_urls or [None] * len(configs)
+    search_queues = [queue.Queue(maxsize=queue_size) for _ in configs]
+    pending_searches = queue.Queue()
+    for index in range(len(configs)):
+        pending_searches.put(index)
+    post_queue = queue.Queue(maxsize=queue_size)
+    download_queue = queue.Queue(maxsize=queue_size)
+    watch_queues(busquedas=search_queues, posts=post_queue, descargas=download_queue)
+    stats = new_search_stats(configs)
+    stats_lock = threading.Lock()
+
+    total_size = None
+    if all(urls is not None for urls in file_urls):
+        # Si ya calculamos el tamaño de todo, la barra puede mostrar el total
+        with resolve_cache_lock:
+            sizes = [
+                resolve_cache.get(normalize_post_url(u, config['base_url']), {}).get('size')
+                for config, urls in zip(configs, file_urls) for u in urls
+            ]
+        total_size = sum(sizes) if sizes and all(sizes) else None
+
+    progress_bar = tqdm(
+        desc="Descargando",
+        total=total_size,
+        unit='iB',
+        unit_scale=True,
+        unit_divisor=1024,
+        dynamic_ncols=True
+    )
+
+    def count(key, index):
+        with stats_lock:
+            postfix = count_search_stat(stats, key, index)
+        with progress_lock:
+            progress_bar.set_postfix(postfix)
+
+    def crawler():
+        # Solo unas pocas búsquedas se recorren a la vez; cuando una acaba empieza la siguiente
+        while not stop_event.is_set():
+            try:
+                index = pending_searches.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                source = file_urls[index] if file_urls[index] is not None else iter_search_posts(configs[index])
+                for file_url in source:
+                    if not queue_put(search_queues[index], file_url):
+                        return
+            except PageFetchError as e:
+                tqdm.write(str(e))
+                count('fallidos', index)
+            except Exception as e:
+                tqdm.write(f"hemos tenido un error al recorrer la búsqueda {configs[index]['search_url']}: {e}")
+            finally:
+                queue_put(search_queues[index], None)
+
+    def scheduler():
+        seen = set()
+        active = list(range(len(configs)))
+        try:
+            while active and not stop_event.is_set():
+                delivered = False
+                for index in list(active):
+                    for _ in range(configs[index].get('weight', 1)):
+                        try:
+                            file_url = search_queues[index].get_nowait()
+                        except queue.Empty:
+                            break
+                        delivered = True
+                        if file_url is None:
+                            active.remove(index)
+                            break
+                        # Un post que sale en varias búsquedas se resuelve y se descarga una sola vez
+                        post_url = normalize_post_url(file_url, configs[index]['base_url'])
+                        if post_url in seen:
+                            count('repetidos', index)
+                            continue
+                        seen.add(post_url)
+                        if not queue_put(post_queue, (index, post_url)):
+                            return
+                        count('encontrados', index)
+                if not delivered:
+                    stop_event.wait(0.05)
+        finally:
+            for _ in range(resolve_workers):
+                queue_put(post_queue, None)
+
+    def resolver():
+        while True:
+            item = post_queue.get()
+            if item is None:
+                return
+            index, file_url = item
+            try:
+                entry, filepath = prepare_post(file_url, configs[index])
+            except Exception as e:
+                tqdm.write(f"hemos tenido un error al procesar {file_url}: {e}")
+                entry, filepath = None, None
+            if filepath:
+                count('descargados', index)
+            elif entry:
+                queue_put(download_queue, (index, entry))
+            else:
+                count('fallidos', index)
+
+    def downloader():
+        while True:
+            item = download_queue.get()
+            if item is None:
+                return
+            index, entry = item
+            try:
+                filepath = fetch_post(entry, folder, progress_bar)
+            except Exception as e:
+                tqdm.write(f"hemos tenido un error al procesar {entry['post_url']}: {e}")
+                filepath = None
+            count('descargados' if filepath else 'fallidos', index)
+
+    crawler_threads = start_threads(crawler, min(active_searches, len(configs)), 'crawler')
+    scheduler_threads = start_threads(scheduler, 1, 'scheduler')
+    resolver_threads = start_threads(resolver, resolve_workers, 'resolver')
+    downloader_threads = start_threads(downloader, download_workers, 'downloader')
+    for thread in crawler_threads + scheduler_threads + resolver_threads:
+        thread.join()
+    for _ in range(download_workers):
+        queue_put(download_queue, None)
+    for thread in downloader_threads:
+        thread.join()
+    progress_bar.close()
+    return stats
+
+@asynccontextmanager
+async def async_slot(url, limits):
+    # Un semáforo global para todo lo que está en vuelo y otro por host, con el mismo tope que el
+    # motor de hilos. El turno del limitador se pide antes, para no ocupar un hueco mientras esperamos
+    clock = profile_clock()
+    delay = get_rate_limiter(url).reserve()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    host = get_host(url)
+    host_semaphore = limits['hosts'].get(host)
+    if host_semaphore is None:
+        host_semaphore = limits['hosts'][host] = asyncio.Semaphore(HOST_CONNECTIONS.get(host, DEFAULT_HOST_CONNECTIONS))
+    async with host_semaphore, limits['global']:
+        if clock:
+            profile_add('espera', clock)
+        yield
+
+def request_timer():
+    # La latencia se cuenta desde que httpx empieza a enviar la petición: lo que espera antes por
+    # una conexión libre de su pool no es culpa del servidor y no debe frenar al limitador
+    timer = {'started': time.monotonic()}
+
+    async def trace(event, info):
+        if event.endswith('send_request_headers.started'):
+            timer['started'] = time.monotonic()
+
+    return timer, {'trace': trace}
+
+async def async_request(client, url, limits, retries=MAX_RETRIES, headers=None):
+    for attempt in range(retries):
+        try:
+            async with async_slot(url, limits):
+                timer, extensions = request_timer()
+                try:
+                    response = await client.get(url, headers=headers, extensions=extensions)
+                except (httpx.TimeoutException, httpx.ConnectError):
+                    record_response(url, None, timer['started'])
+                    raise
+                record_response(url, response, timer['started'])
+            # httpx trata cualquier respuesta que no sea 2xx como error, también el 304 de una revalidación
+            if response.status_code != 304:
+                response.raise_for_status()
+            return response
+        except httpx.HTTPError as e:
+            if attempt < retries - 1 and is_retryable(e) and not stop_event.is_set():
+                record_metric_retry()
+                delay = retry_delay(attempt, e)
+                tqdm.write(f"Error al acceder a {url}: {e}. Reintentando en {delay:.1f} segundos...")
+                await asyncio.sleep(delay)
+            else:
+                tqdm.write(f"Error al acceder a {url} después de {attempt + 1} intentos: {e}")
+                return None
+    return None
+
+async def async_fetch_page(client, url, limits, route):
+    with metric_stage(ROUTE_STAGES.get(route, route), url):
+        text, entry, headers = page_cache_lookup(url, route)
+        if text is not None:
+            return text
+        response = await async_request(client, url, limits, headers=headers)
+        if not response:
+            return None
+        return page_cache_response(url, entry, response)
+
+async def async_fetch_search_page(client, config, limits, page):
+    resolver = get_resolver(config)
+    page_url = resolver.page_url(config, page)
+    tqdm.write(f"Accediendo a la página: {page_url}")
+    text = await async_fetch_page(client, page_url, limits, 'first_page' if page == 1 else 'page')
+    if text is None:
+        return None
+    posts = await async_parse_html(resolver.parse_page, config, text)
+    remember_listed(posts, config)
+    return [post['post_url'] for post in posts]
+
+async def async_iter_new_posts(client, config, limits):
+    # Igual que iter_new_posts: lo pendiente de antes y página a página hasta una entera ya conocida
+    search_url = config['search_url']
+    unfinished = journal_unfinished_posts(search_url)
+    for post_url in unfinished:
+        yield post_url
+    earlier = set(unfinished)
+    seen = set(earlier)
+    page = 1
+    while not stop_event.is_set():
+        post_urls = await async_fetch_search_page(client, config, limits, page)
+        if post_urls is None:
+            if stop_event.is_set():
+                break
+            raise PageFetchError(f"No se pudo leer la página {page} de {search_url}")
+        if not post_urls:
+            break
+        known = journal_known_posts(post_urls)
+        journal_record_page(search_url, page, post_urls)
+        for post_url in post_urls:
+            if post_url not in known and post_url not in seen:
+                seen.add(post_url)
+                yield post_url
+        if all(post_url in known or post_url in earlier for post_url in post_urls):
+            break
+        page += 1
+
+async def async_iter_search_posts(client, config, limits):
+    if config.get('sync'):
+        async for post_url in async_iter_new_posts(client, config, limits):
+            yield post_url
+        return
+    search_url = config['search_url']
+    resolver = get_resolver(config)
+    total_pages = None
+    pages_url = resolver.pages_url(config)
+    if pages_url is not None:
+        text = await async_fetch_page(client, pages_url, limits, 'count')
+        if text is not None:
+            total_pages = await async_parse_html(resolver.parse_pages, config, text)
+    crawled_pages = journal_start_crawl(search_url, total_pages)
+    window = config.get('crawl_workers', CRAWL_WORKERS) * 2
+    last_page = math.inf if total_pages is None else total_pages
+
+    seen = set()
+    pending = {}
+    failed_pages = []
+    submitted = 0
+    page = 0
+    try:
+        while page < last_page:
+            page += 1
+            if stop_event.is_set():
+                return
+            while submitted < last_page and submitted < page + window:
+                submitted += 1
+                if submitted not in crawled_pages:
+                    pending[submitted] = asyncio.ensure_future(async_fetch_search_page(client, config, limits, submitted))
+            if page in crawled_pages:
+                post_urls = journal_page_posts(search_url, page)
+            else:
+                post_urls = await pending.pop(page)
+                if post_urls is None:
+                    if stop_event.is_set():
+                        return
+                    failed_pages.append(page)
+                    if total_pages is None:
+                        break
+                    continue
+                journal_record_page(search_url, page, post_urls)
+            if not post_urls and total_pages is None:
+                break
+            for post_url in post_urls:
+                if post_url in seen:
+                    continue
+                seen.add(post_url)
+                yield post_url
+    finally:
+        for task in pending.values():
+            task.cancel()
+    if failed_pages:
+        raise PageFetchError(crawl_error(search_url, failed_pages))
+    journal_finish_crawl(search_url)
+
+async def async_prepare_post(client, file_url, config, limits):
+    post_url = normalize_post_url(file_url, config['base_url'])
+    filepath = journal_done_filepath(post_url)
+    if filepath:
+        return None, filepath
+    entry = lookup_resolved(post_url)
+    if entry is None:
+        download_url = None
+        resolver = get_resolver(config)
+        text = await async_fetch_page(client, resolver.post_url(config, post_url), limits, 'post')
+        if text is not None:
+            download_url = await async_parse_html(resolver.parse_post, config, text)
+        entry = remember_resolved(post_url, download_url, config)
+    if not entry:
+        tqdm.write(f"No se pudo encontrar el enlace de descarga para {file_url}")
+    return entry, None
+
+async def async_download_file(client, url, folder, limits, retries=MAX_RETRIES, progress=None, expected_size=None, md5=None):
+    # Misma lógica que download_file: .part, reanudación con Range y paso al almacén al terminar
+    filepath = find_stored(url, folder, md5) or adopt_existing(url, folder, expected_size, md5)
+    if filepath:
+        return filepath
+    part_path = part_path_for(url, folder)
+    meta_path = part_path + '.json'
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    counted = 0
+
+    for attempt in range(retries):
+        try:
+            meta = read_part_meta(meta_path)
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            # Un .part por segmentos del motor de hilos está reservado entero: aquí no se puede seguir
+            if offset and (meta.get('url') != url or meta.get('segments')):
+                discard_part(part_path, meta_path)
+                offset = 0
+                meta = {}
+            headers = {}
+            if offset:
+                headers['Range'] = f'bytes={offset}-'
+                etag = meta.get('etag')
+                validator = etag if etag and not etag.startswith('W/') else meta.get('last_modified')
+                if validator:
+                    headers['If-Range'] = validator
+
+            async with async_slot(url, limits):
+                timer, extensions = request_timer()
+                async with client.stream('GET', url, headers=headers, extensions=extensions) as r:
+                    record_response(url, r, timer['started'])
+                    if r.status_code == 416:
+                        discard_part(part_path, meta_path)
+                        raise Exception("El servidor rechazó el rango pedido; se reinicia la descarga.")
+                    r.raise_for_status()
+                    if r.status_code == 206:
+                        content_range = parse_content_range(r.headers.get('content-range'))
+                        if not content_range or content_range[0] != offset:
+                            discard_part(part_path, meta_path)
+                            raise Exception("El Content-Range de la respuesta no coincide con lo ya descargado.")
+                        total_size = content_range[2] or offset + int(r.headers.get('content-length', 0))
+                        mode = 'ab'
+                    else:
+                        total_size = int(r.headers.get('content-length', 0))
+                        mode = 'wb'
+                        if progress is not None and counted:
+                            update_progress(progress, -counted)
+                            counted = 0
+                        write_part_meta(meta_path, {
+                            'url': url,
+                            'etag': r.headers.get('etag'),
+                            'last_modified': r.headers.get('last-modified'),
+                            'total': total_size,
+                        })
+                    hashers = new_hashers(part_path, offset if mode == 'ab' else 0)
+                    received = 0
+                    try:
+                        with open(part_path, mode) as f:
+                            async for chunk in r.aiter_bytes(65536):
+                                if stop_event.is_set():
+                                    raise DownloadCancelled()
+                                write_chunk(f, chunk, hashers)
+                                counted += len(chunk)
+                                received += len(chunk)
+                                if progress is not None:
+                                    update_progress(progress, len(chunk))
+                                delay = bandwidth_delay(url, len(chunk))
+                                if delay > 0:
+                                    await asyncio.sleep(delay)
+                    finally:
+                        record_metric_bytes(url, received)
+
+            total_size = total_size or expected_size
+            if total_size and os.path.getsize(part_path) != total_size:
                 raise Exception("El tamaño del archivo descargado no coincide con el tamaño esperado.")
-            
+            filepath = store_part(part_path, url, folder, hashers, md5)
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
             return filepath
+        except DownloadCancelled:
+            return None
         except Exception as e:
-            if attempt < retries - 1:
-                print(f"Error al descargar {url}: {e}. Reintentando en {RETRY_DELAY} segundos...")
-                time.sleep(RETRY_DELAY)
+            if stop_event.is_set():
+                return None
+            if attempt < retries - 1 and is_retryable(e):
+                record_metric_retry()
+                delay = retry_delay(attempt, e)
+                tqdm.write(f"Error al descargar {url}: {e}. Reintentando en {delay:.1f} segundos...")
+                await asyncio.sleep(delay)
             else:
-                print(f"Error al descargar {url} después de {retries} intentos: {e}")
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+                tqdm.write(f"Error al descargar {url} después de {attempt + 1} intentos: {e}")
                 return None
     return None
 
+async def async_fetch_post(client, entry, folder, limits, progress=None):
+    post_url = entry['post_url']
+    download_url = entry['download_url']
+    part_path = part_path_for(download_url, folder)
+    journal_mark(post_url, 'downloading', bytes_done=part_bytes_done(part_path), total_bytes=entry['size'])
+    md5 = entry.get('md5') or extract_url_md5(download_url)
+    with metric_stage('descarga', download_url):
+        filepath = await async_download_file(client, download_url, folder, limits, progress=progress, expected_size=entry['size'], md5=md5)
+    if filepath:
+        size = os.path.getsize(filepath)
+        journal_mark(post_url, 'done', filepath=filepath, bytes_done=size, total_bytes=size, error=None)
+    else:
+        bytes_done = part_bytes_done(part_path)
+        if stop_event.is_set():
+            journal_mark(post_url, 'downloading', bytes_done=bytes_done)
+        else:
+            journal_mark(post_url, 'failed', bytes_done=bytes_done, error='descarga fallida')
+            tqdm.write(f"No se pudo descargar el archivo desde {download_url}")
+    return filepath
+
+async def run_async_pipeline(configs, folder, file_urls=None):
+    # Las mismas etapas que run_pipeline, pero como tareas de un único bucle de eventos;
+    # lo que limita las peticiones en vuelo es el semáforo global, no el número de hilos
+    concurrency = configs[0].get('async_concurrency', ASYNC_CONCURRENCY)
+    connections = configs[0].get('async_connections', ASYNC_CONNECTIONS)
+    queue_size = configs[0].get('queue_size', QUEUE_SIZE)
+    crawl_slots = asyncio.Semaphore(configs[0].get('active_searches', ACTIVE_SEARCHES))
+    file_urls = file_urls or [None] * len(configs)
+    limits = {'global': asyncio.Semaphore(concurrency), 'hosts': {}}
+    search_queues = [asyncio.Queue(maxsize=queue_size) for _ in configs]
+    post_queue = asyncio.Queue(maxsize=queue_size)
+    download_queue = asyncio.Queue(maxsize=queue_size)
+    watch_queues(busquedas=search_queues, posts=post_queue, descargas=download_queue)
+    stats = new_search_stats(configs)
+    progress_bar = tqdm(
+        desc="Descargando",
+        unit='iB',
+        unit_scale=True,
+        unit_divisor=1024,
+        dynamic_ncols=True
+    )
+
+    def count(key, index):
+        progress_bar.set_postfix(count_search_stat(stats, key, index))
+
+    session = get_session()
+    client = httpx.AsyncClient(
+        headers=dict(session.headers),
+        cookies=dict(session.cookies),
+        timeout=30,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+    )
+
+    async def crawler(index):
+        async with crawl_slots:
+            try:
+                if file_urls[index] is not None:
+                    for file_url in file_urls[index]:
+                        await search_queues[index].put(file_url)
+                else:
+                    async for post_url in async_iter_search_posts(client, configs[index], limits):
+                        await search_queues[index].put(post_url)
+            except PageFetchError as e:
+                tqdm.write(str(e))
+                count('fallidos', index)
+            except Exception as e:
+                tqdm.write(f"hemos tenido un error al recorrer la búsqueda {configs[index]['search_url']}: {e}")
+            finally:
+                await search_queues[index].put(None)
+
+    async def scheduler():
+        seen = set()
+        active = list(range(len(configs)))
+        try:
+            while active and not stop_event.is_set():
+                delivered = False
+                for index in list(active):
+                    for _ in range(configs[index].get('weight', 1)):
+                        try:
+                            file_url = search_queues[index].get_nowait()
+                        except asyncio.QueueEmpty:
+                            break
+                        delivered = True
+                        if file_url is None:
+                            active.remove(index)
+                            break
+                        post_url = normalize_post_url(file_url, configs[index]['base_url'])
+                        if post_url in seen:
+                            count('repetidos', index)
+                            continue
+                        seen.add(post_url)
+                        await post_queue.put((index, post_url))
+                        count('encontrados', index)
+                if not delivered:
+                    await asyncio.sleep(0.05)
+        finally:
+            for _ in range(concurrency):
+                await post_queue.put(None)
+
+    async def resolver():
+        while True:
+            item = await post_queue.get()
+            if item is None:
+                return
+            index, file_url = item
+            try:
+                entry, filepath = await async_prepare_post(client, file_url, configs[index], limits)
+            except Exception as e:
+                tqdm.write(f"hemos tenido un error al procesar {file_url}: {e}")
+                entry, filepath = None, None
+            if filepath:
+                count('descargados', index)
+            elif entry:
+                await download_queue.put((index, entry))
+            else:
+                count('fallidos', index)
+
+    async def downloader():
+        while True:
+            item = await download_queue.get()
+            if item is None:
+                return
+            index, entry = item
+            try:
+                filepath = await async_fetch_post(client, entry, folder, limits, progress_bar)
+            except Exception as e:
+                tqdm.write(f"hemos tenido un error al procesar {entry['post_url']}: {e}")
+                filepath = None
+            count('descargados' if filepath else 'fallidos', index)
+
+    async with client:
+        downloaders = [asyncio.ensure_future(downloader()) for _ in range(concurrency)]
+        crawlers = [crawler(index) for index in range(len(configs))]
+        await asyncio.gather(scheduler(), *crawlers, *[resolver() for _ in range(concurrency)])
+        for _ in range(concurrency):
+            await download_queue.put(None)
+        await asyncio.gather(*downloaders)
+    progress_bar.close()
+    return stats
+
+def run_searches(configs, folder, file_urls=None):
+    # Todas las búsquedas comparten motor, sesión, limitadores y presupuesto de descargas
+    if configs[0].get('engine', ENGINE) == 'async':
+        if httpx is None:
+            raise RuntimeError("El motor async necesita httpx (pip install httpx)")
+        stats = asyncio.run(run_async_pipeline(configs, folder, file_urls))
+    else:
+        stats = run_pipeline(configs, folder, file_urls)
+    for config in configs:
+        journal_update_newest_post_id(config['search_url'])
+    return stats
+
+def run_engine(config, folder, file_urls=None):
+    stats = run_searches([config], folder, [file_urls])
+    return stats['descargados'], stats['fallidos']
+
+def setup_run(config, download_folder):
+    # Lo que se prepara una sola vez por proceso; BDT.py lo comparte entre todas las búsquedas
+    state_folder = os.path.join(download_folder, STATE_FOLDER)
+    os.makedirs(state_folder, exist_ok=True)
+    config['resolve_cache_path'] = os.path.join(state_folder, RESOLVE_CACHE_FILE)
+    known = load_resolve_cache(config['resolve_cache_path'])
+    if known:
+        print(f"Caché de resolución cargada: {known} posts ya conocidos.")
+    config.setdefault('download_workers', DOWNLOAD_WORKERS)
+    open_journal(os.path.join(state_folder, JOURNAL_FILE))
+    configure_run(config, state_folder)
+    configure_profile(config)
+    start_parse_pool(config.get('parse_processes', PARSE_PROCESSES))
+    start_metrics(config.get('metrics_file'), config.get('metrics_interval', METRICS_INTERVAL))
+    start_profiling(config.get('profiling'), os.path.join(state_folder, PROFILE_FOLDER))
+
+def configure_run(config, state_folder):
+    # Lo que vale para toda la ejecución y no por búsqueda; un trabajador lo toma de la cola
+    # page_cache_size = 0 desactiva la caché de páginas
+    max_size = config.get('page_cache_size', PAGE_CACHE_MAX_SIZE)
+    if max_size:
+        open_page_cache(os.path.join(state_folder, PAGE_CACHE_FILE), max_size)
+    set_parser_backend(config.get('parser'))
+    set_output_layout(config.get('layout'))
+    set_md5_patterns(config.get('md5_patterns'))
+
+def configure_profile(config):
+    # Límites por host, cabeceras y selectores de un sitio; con varios perfiles se suman
+    HOST_CONNECTIONS.update(config.get('host_connections', {}))
+    HOST_RATES.update(config.get('host_rates', {}))
+    BANDWIDTH_LIMITS.update(config.get('host_bandwidth', {}))
+    PAGE_CACHE_TTL.update(config.get('page_cache_ttl', {}))
+    if config.get('bandwidth_limit'):
+        BANDWIDTH_LIMITS['*'] = config['bandwidth_limit']
+    configure_session(config.get('headers'), config.get('cookies'))
+    get_resolver(config)
+    compile_selectors(config)
+
+def open_work_queue(path):
+    # Cola de trabajo compartida entre máquinas: un SQLite en almacenamiento compartido.
+    # Sin WAL, que no funciona sobre NFS/SMB; las escrituras son pocas y cortas
+    global work_queue_db
+    conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('''CREATE TABLE IF NOT EXISTS searches (
+        id INTEGER PRIMARY KEY,
+        search_url TEXT UNIQUE,
+        config TEXT,
+        crawled INTEGER DEFAULT 0
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS items (
+        post_url TEXT PRIMARY KEY,
+        search_id INTEGER,
+        state TEXT NOT NULL,
+        worker TEXT,
+        lease_until REAL,
+        attempts INTEGER DEFAULT 0,
+        filepath TEXT,
+        error TEXT,
+        updated_at REAL
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS items_by_state ON items (state, lease_until)')
+    with work_queue_lock:
+        work_queue_db = conn
+    return conn
+
+@contextmanager
+def work_queue_transaction():
+    # BEGIN IMMEDIATE coge el bloqueo de escritura al empezar: dos trabajadores no pueden
+    # leer la misma fila libre y quedársela los dos
+    with work_queue_lock:
+        work_queue_db.execute('BEGIN IMMEDIATE')
+        try:
+            yield work_queue_db
+        except BaseException:
+            work_queue_db.execute('ROLLBACK')
+            raise
+        work_queue_db.execute('COMMIT')
+
+def work_queue_add_search(config):
+    # La configuración viaja con la cola, así los trabajadores no necesitan el archivo de perfiles
+    shared = {key: value for key, value in config.items() if key not in WORK_QUEUE_LOCAL_KEYS}
+    with work_queue_transaction() as db:
+        db.execute(
+            'INSERT INTO searches (search_url, config, crawled) VALUES (?, ?, 0) '
+            'ON CONFLICT(search_url) DO UPDATE SET config = excluded.config, crawled = 0',
+            (config['search_url'], json.dumps(shared)),
+        )
+        return db.execute('SELECT id FROM searches WHERE search_url = ?', (config['search_url'],)).fetchone()['id']
+
+def work_queue_push(search_id, post_urls):
+    # Lo que ya estaba en la cola (de esta u otra búsqueda) no se vuelve a meter
+    now = time.time()
+    with work_queue_transaction() as db:
+        db.executemany(
+            'INSERT OR IGNORE INTO items (post_url, search_id, state, updated_at) VALUES (?, ?, ?, ?)',
+            [(post_url, search_id, 'pending', now) for post_url in post_urls],
+        )
+
+def work_queue_finish_crawl(search_id):
+    with work_queue_transaction() as db:
+        db.execute('UPDATE searches SET crawled = 1 WHERE id = ?', (search_id,))
+
+def work_queue_lease(worker, count, lease=WORK_QUEUE_LEASE):
+    # Devuelve hasta count posts (post_url, search_id); los de trabajadores caídos vuelven al caducar
+    now = time.time()
+    with work_queue_transaction() as db:
+        db.execute(
+            "UPDATE items SET state = 'failed', error = 'demasiados intentos', updated_at = ? "
+            "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+            (now, now, WORK_QUEUE_MAX_ATTEMPTS),
+        )
+        rows = db.execute(
+            "SELECT post_url, search_id FROM items WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+            "ORDER BY rowid LIMIT ?",
+            (now, count),
+        ).fetchall()
+        db.executemany(
+            "UPDATE items SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? "
+            "WHERE post_url = ?",
+            [(worker, now + lease, now, row['post_url']) for row in rows],
+        )
+    return [(row['post_url'], row['search_id']) for row in rows]
+
+def work_queue_renew(worker, post_urls, lease=WORK_QUEUE_LEASE):
+    if not post_urls:
+        return
+    now = time.time()
+    with work_queue_transaction() as db:
+        db.executemany(
+            "UPDATE items SET lease_until = ? WHERE post_url = ? AND worker = ? AND state = 'leased'",
+            [(now + lease, post_url, worker) for post_url in post_urls],
+        )
+
+def work_queue_finish(worker, post_url, filepath=None, error=None):
+    # Un fallo vuelve a la cola (quizá otro nodo tenga más suerte) hasta agotar los intentos.
+    # Solo cuenta si el post sigue alquilado a este trabajador: si su alquiler caducó y otro
+    # lo cogió, el resultado es del otro
+    now = time.time()
+    with work_queue_transaction() as db:
+        if filepath:
+            db.execute(
+                "UPDATE items SET state = 'done', filepath = ?, error = NULL, updated_at = ? "
+                "WHERE post_url = ? AND worker = ? AND state = 'leased'",
+                (filepath, now, post_url, worker),
+            )
+        else:
+            db.execute(
+                "UPDATE items SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "error = ?, updated_at = ? WHERE post_url = ? AND worker = ? AND state = 'leased'",
+                (WORK_QUEUE_MAX_ATTEMPTS, error, now, post_url, worker),
+            )
+
+def work_queue_config(search_id):
+    with work_queue_lock:
+        row = work_queue_db.execute('SELECT config FROM searches WHERE id = ?', (search_id,)).fetchone()
+    return json.loads(row['config'])
+
+def work_queue_progress():
+    with work_queue_lock:
+        counts = {state: 0 for state in ('pending', 'leased', 'done', 'failed')}
+        for row in work_queue_db.execute('SELECT state, count(*) AS n FROM items GROUP BY state'):
+            counts[row['state']] = row['n']
+        row = work_queue_db.execute('SELECT count(*) AS n FROM searches WHERE crawled = 0').fetchone()
+        counts['crawling'] = row['n']
+    return counts
+
+def run_coordinator(configs, wait=True):
+    # Recorre las búsquedas y mete sus posts en la cola; resolver y descargar es cosa de los trabajadores
+    unread = 0
+    for config in configs:
+        search_id = work_queue_add_search(config)
+        batch = []
+        try:
+            for post_url in iter_search_posts(config):
+                batch.append(post_url)
+                if len(batch) >= WORK_QUEUE_BATCH * 8:
+                    work_queue_push(search_id, batch)
+                    batch = []
+        except PageFetchError as e:
+            # Lo ya encontrado se descarga igual; la búsqueda se terminará de recorrer en otra pasada
+            print(e)
+            unread += 1
+        work_queue_push(search_id, batch)
+        if stop_event.is_set():
+            return dict(work_queue_progress(), sin_recorrer=unread)
+        work_queue_finish_crawl(search_id)
+    progress = work_queue_progress()
+    while wait and (progress['pending'] or progress['leased']) and not stop_event.is_set():
+        print(f"Cola: {progress['pending']} pendientes, {progress['leased']} en curso, {progress['done']} hechos, {progress['failed']} fallidos")
+        stop_event.wait(WORK_QUEUE_POLL)
+        progress = work_queue_progress()
+    return dict(progress, sin_recorrer=unread)
+
+def run_worker(folder, workers=DOWNLOAD_WORKERS, lease=WORK_QUEUE_LEASE):
+    # Cada hilo alquila unos pocos posts, los resuelve y descarga con las funciones de siempre y avisa
+    # a la cola; otro hilo va renovando el alquiler de lo que está en curso para que no caduque
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    configs = {}
+    configs_lock = threading.Lock()
+    in_flight = set()
+    stats = {'descargados': 0, 'fallidos': 0}
+    stats_lock = threading.Lock()
+    base_config = {'resolve_cache_path': os.path.join(folder, STATE_FOLDER, RESOLVE_CACHE_FILE)}
+    progress_bar = tqdm(desc=f"Trabajador {worker}", unit='iB', unit_scale=True, unit_divisor=1024, dynamic_ncols=True)
+
+    def search_config(search_id):
+        with configs_lock:
+            if search_id not in configs:
+                config = dict(work_queue_config(search_id), **base_config)
+                # Estructura, patrones de MD5, parser y caché de páginas son de toda la ejecución:
+                # se aplican con la primera búsqueda, antes de que ningún hilo empiece a descargar
+                if not configs:
+                    configure_run(config, os.path.join(folder, STATE_FOLDER))
+                configure_profile(config)
+                configs[search_id] = config
+            return configs[search_id]
+
+    def heartbeat():
+        while not stop_event.wait(lease / 3):
+            with stats_lock:
+                leased = list(in_flight)
+            work_queue_renew(worker, leased, lease)
+
+    def process():
+        while not stop_event.is_set():
+            items = work_queue_lease(worker, WORK_QUEUE_BATCH, lease)
+            if not items:
+                progress = work_queue_progress()
+                if not (progress['pending'] or progress['leased'] or progress['crawling']):
+                    return
+                # El coordinador aún está recorriendo o hay alquileres de otros que pueden caducar
+                stop_event.wait(WORK_QUEUE_POLL)
+                continue
+            with stats_lock:
+                in_flight.update(post_url for post_url, _ in items)
+            for post_url, search_id in items:
+                filepath, error = None, None
+                try:
+                    if not stop_event.is_set():
+                        entry, filepath = prepare_post(post_url, search_config(search_id))
+                        if entry:
+                            filepath = fetch_post(entry, folder, progress_bar)
+                    error = None if filepath else 'no se pudo descargar'
+                except Exception as e:
+                    error = str(e)
+                if not stop_event.is_set():
+                    work_queue_finish(worker, post_url, filepath, error)
+                with stats_lock:
+                    in_flight.discard(post_url)
+                    stats['descargados' if filepath else 'fallidos'] += 1
+                    postfix = {'archivos': stats['descargados'], 'fallos': stats['fallidos']}
+                with progress_lock:
+                    progress_bar.set_postfix(postfix)
+
+    start_threads(heartbeat, 1, 'heartbeat')
+    for thread in start_threads(process, workers, 'worker'):
+        thread.join()
+    progress_bar.close()
+    return stats['descargados'], stats['fallidos']
+
+def print_run_stats():
+    stats = get_connection_stats()
+    if stats['peticiones']:
+        print(f"Conexiones: {stats['reutilizadas']} reutilizadas, {stats['nuevas']} nuevas ({stats['peticiones']} peticiones)")
+    for host, rate in get_rate_stats().items():
+        print(f"{host}: {rate['ritmo']:.1f} peticiones/s al terminar, {rate['limitado']} respuestas 429/503")
+    cache = get_page_cache_stats()
+    pages = cache['aciertos'] + cache['revalidadas'] + cache['fallos']
+    if pages:
+        print(f"Caché de páginas: {cache['aciertos']} aciertos, {cache['revalidadas']} revalidadas (304), {cache['fallos']} descargadas; "
+              f"{(cache['aciertos'] + cache['revalidadas']) / pages:.0%} sin bajar el cuerpo, {format_size(cache['bytes'])} en disco")
+
 def main():
     config = get_user_input()
-    total_pages = get_total_pages(config['search_url'])
-    
-    all_file_urls = []
-    for page in range(1, total_pages + 1):
-        page_url = config['search_url'].replace('{{page}}', str(page))
-        print(f"Accediendo a la página: {page_url}")
-        all_file_urls.extend(get_file_urls(page_url, config['file_link_selector'], config['file_url_attribute']))
-    
-    total_files = len(all_file_urls)
-    print(f"se han encontrado {total_files} archivos para descargar.")
-    
-    calculate_size = input("quieres calcular el tamaño total que se va a descqargar? esto podria llevar mucho tiempo (s/n): ").lower()
-    if calculate_size == 's':
-        total_size = calculate_total_size(all_file_urls, config)
-        print(f"Tamaño total de la descarga: {format_size(total_size)}")
-    else:
-        print("Ok")
-        print("pasamos de calcular el tamaño de la descarga")
+    if '--async' in sys.argv[1:]:
+        config['engine'] = 'async'
+    if {'--perfilado', '--profile'} & set(sys.argv[1:]):
+        config['profiling'] = True
+    download_folder = "descarga"
+    setup_run(config, download_folder)
+    try:
+        if journal_search_completed(config['search_url']):
+            sync = input("Ya has descargado esta búsqueda antes, quieres bajar solo los posts nuevos? (s/n): ").lower()
+            config['sync'] = sync == 's'
     
-    proceed = input("Deseas empezar a descargar? (s/n): ").lower()
-    if proceed != 's':
-        print("Descarga cancelada")
-        return
+        calculate_size = input("quieres calcular el tamaño total que se va a descqargar? esto podria llevar mucho tiempo (s/n): ").lower()
+        if calculate_size == 's':
+            # Para calcular el tamaño hay que recorrer la búsqueda entera antes de descargar
+            all_file_urls = crawl_search(config)
+            total_files = len(all_file_urls)
+            print(f"se han encontrado {total_files} archivos para descargar.")
+            total_size = calculate_total_size(all_file_urls, config)
+            print(f"Tamaño total de la descarga: {format_size(total_size)}")
+        else:
+            print("Ok")
+            print("pasamos de calcular el tamaño de la descarga, empezaremos a descargar según vayamos encontrando archivos")
+            all_file_urls = None
     
-    download_folder = "descarga"
-    os.makedirs(download_folder, exist_ok=True)
+        proceed = input("Deseas empezar a descargar? (s/n): ").lower()
+        if proceed != 's':
+            print("Descarga cancelada")
+            return
     
-    for i, file_url in enumerate(all_file_urls, 1):
-        print(f"\nProcesando archivo {i} de {total_files}")
-        try:
-            if not file_url.startswith(('http://', 'https://')):
-                file_url = config['base_url'] + file_url
-            download_url = get_download_url(file_url, config['download_link_selector'], config['base_url'])
-            if download_url:
-                filepath = download_file(download_url, download_folder)
-                if filepath:
-                    print(f"Archivo guardado en: {filepath}")
-                else:
-                    print(f"No se pudo descargar el archivo desde {download_url}")
-            else:
-                print(f"No se pudo encontrar el enlace de descarga para {file_url}")
-        except Exception as e:
-            print(f"hemos tenido un error al procesar {file_url}: {e}")
+        completed, failed = run_engine(config, download_folder, all_file_urls)
+        print(f"\nArchivos descargados: {completed}, fallidos: {failed}")
+        print_run_stats()
+    finally:
+        finish_run()
     
     print("\nDescarga completada.")
 